@@ -1,14 +1,19 @@
 from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
-from sqlalchemy.orm import joinedload
-from sqlalchemy import inspect, text
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import inspect, text, case, update, insert, delete, Integer, literal, literal_column
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.utils import secure_filename
-from datetime import datetime, date, timedelta
-from flask import make_response
-import io, csv
-import os, secrets, string
+from datetime import datetime, date, timedelta, timezone
+from flask import Response, stream_with_context, g
+import io, csv, zlib, json
+import os, re, secrets, string
 import math
+import click
+from types import SimpleNamespace
 
 app = Flask(__name__)
 app.secret_key = 'pos_secret_key'
@@ -18,11 +23,51 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'static', 'uploads')
+# Penyimpanan kolom tanggal transaksi/mutasi/produksi:
+# default VARCHAR 'YYYY-MM-DD'; POS_TANGGAL_INT=1 → INTEGER YYYYMMDD (key index lebih kecil & cepat).
+# Tabel lama dikonversi otomatis saat start (lihat MIGRASI RINGAN).
+app.config['TANGGAL_INT'] = os.environ.get('POS_TANGGAL_INT') == '1'
+# POS_TOLAK_STOK_MINUS=1 → checkout ditolak jika stok produk tidak cukup (default: stok boleh minus).
+app.config['TOLAK_STOK_MINUS'] = os.environ.get('POS_TOLAK_STOK_MINUS') == '1'
+# POS_GRID_VIRTUAL=1 → halaman kasir memuat katalog via JSON (ETag) & merender hanya baris yang terlihat.
+# Bisa dipaksa per request: /?grid=virtual atau /?grid=biasa.
+app.config['GRID_VIRTUAL'] = os.environ.get('POS_GRID_VIRTUAL') == '1'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
 
 # ==================== MODELS ====================
+class TanggalType(TypeDecorator):
+    """
+    Kolom tanggal. Di Python selalu string 'YYYY-MM-DD' (filter/perbandingan tetap sama);
+    di database VARCHAR, atau INTEGER YYYYMMDD jika app.config['TANGGAL_INT'] aktif.
+    """
+    impl = db.String(20)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if app.config.get('TANGGAL_INT'):
+            return dialect.type_descriptor(db.Integer())
+        return dialect.type_descriptor(db.String(20))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, date):
+            value = value.strftime("%Y-%m-%d")
+        if not app.config.get('TANGGAL_INT'):
+            return value
+        digits = ''.join(ch for ch in str(value) if ch.isdigit())
+        return int(digits) if digits else None
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        s = str(value)
+        if len(s) == 8 and s.isdigit():
+            return f"{s[:4]}-{s[4:6]}-{s[6:]}"
+        return value
+
 class Kategori(db.Model):
     __tablename__ = 'kategori'
     id   = db.Column(db.Integer, primary_key=True)
@@ -31,17 +76,21 @@ class Kategori(db.Model):
 
 class Produk(db.Model):
     __tablename__ = 'produk'
+    __table_args__ = (
+        db.Index('ux_produk_barcode', 'barcode', unique=True),  # scan barcode/SKU = 1 lookup index
+    )
     id    = db.Column(db.Integer, primary_key=True)
     nama  = db.Column(db.String(100), nullable=False)
     harga = db.Column(db.Integer, nullable=False)                 # Harga jual utama
     hpp   = db.Column(db.Integer, nullable=False, default=0)      # HPP rata-rata
     stok  = db.Column(db.Integer, nullable=False, default=0)
     foto  = db.Column(db.String(200), nullable=True)
+    barcode = db.Column(db.String(64), nullable=True)  # barcode / SKU (unik, opsional)
 
     # Flag manufaktur (0/1 - SQLite)
     is_manufaktur = db.Column(db.Integer, nullable=False, default=0)
 
-    kategori_id = db.Column(db.Integer, db.ForeignKey('kategori.id'), nullable=True)
+    kategori_id = db.Column(db.Integer, db.ForeignKey('kategori.id'), nullable=True, index=True)
     kategori = db.relationship('Kategori', back_populates='produk')
 
     # Harga-harga preset opsional
@@ -68,6 +117,10 @@ class Produk(db.Model):
 
 class ResepBahan(db.Model):
     __tablename__ = 'resep_bahan'
+    __table_args__ = (
+        db.Index('ix_resep_bahan_produk_id', 'produk_id'),
+        db.Index('ix_resep_bahan_bahan_id', 'bahan_id'),
+    )
     id        = db.Column(db.Integer, primary_key=True)
     produk_id = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)  # produk jadi
     bahan_id  = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)  # bahan (juga produk)
@@ -94,27 +147,48 @@ class Customer(db.Model):
     email      = db.Column(db.String(100), nullable=False)
     no_telepon = db.Column(db.String(20), nullable=True)
     alamat     = db.Column(db.String(200), nullable=True)
+    saldo_piutang = db.Column(db.Integer, nullable=False, default=0)  # Σ sisa transaksi HUTANG
 
 class Room(db.Model):
     __tablename__ = 'room'
+    __table_args__ = (
+        db.Index('ix_room_status_id', 'status', 'id'),  # daftar room per status (keyset id desc)
+    )
     id         = db.Column(db.Integer, primary_key=True)
     kode       = db.Column(db.String(12), unique=True, nullable=False)
     status     = db.Column(db.String(20), nullable=False, default='open')  # open/closed
     created_at = db.Column(db.DateTime, server_default=func.now())
+    closed_at  = db.Column(db.DateTime, nullable=True)  # diisi saat room ditutup (dasar retensi)
     items      = db.relationship('RoomItem', backref='room', cascade='all, delete')
 
 class RoomItem(db.Model):
     __tablename__ = 'room_item'
+    __table_args__ = (
+        # satu baris per produk per room → tambah item = upsert atomik (jumlah = jumlah + ?)
+        db.Index('ux_room_item_room_produk', 'room_id', 'produk_id', unique=True),
+    )
     id        = db.Column(db.Integer, primary_key=True)
     room_id   = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     produk_id = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)
     jumlah    = db.Column(db.Integer, nullable=False, default=0)
     harga     = db.Column(db.Integer, nullable=False, default=0)  # snapshot harga saat masuk
+    version   = db.Column(db.Integer, nullable=False, default=1)  # naik tiap perubahan (compare-and-swap)
 
 class Transaksi(db.Model):
     __tablename__ = 'transaksi'
+    __table_args__ = (
+        # keyset pagination (id desc) + filter di /transaksi
+        db.Index('ix_transaksi_tanggal_status', 'tanggal', 'status'),
+        db.Index('ix_transaksi_tanggal_id', 'tanggal', 'id'),
+        db.Index('ix_transaksi_status_id', 'status', 'id'),
+        # filter total min/max di /transaksi (biasanya bersama rentang tanggal)
+        db.Index('ix_transaksi_tanggal_total', 'tanggal', 'total'),
+        db.Index('ix_transaksi_customer_id', 'customer_id', 'id'),
+        # kunci idempoten dari terminal offline (NULL untuk transaksi kasir biasa)
+        db.Index('ux_transaksi_client_ref', 'client_ref', unique=True),
+    )
     id           = db.Column(db.Integer, primary_key=True)
-    tanggal      = db.Column(db.String(20), nullable=False)       # YYYY-MM-DD
+    tanggal      = db.Column(TanggalType, nullable=False)         # YYYY-MM-DD
     total        = db.Column(db.Integer, nullable=False, default=0)
 
     customer_id  = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True)
@@ -126,19 +200,30 @@ class Transaksi(db.Model):
     sisa         = db.Column(db.Integer, nullable=False, default=0)
     jatuh_tempo  = db.Column(db.String(20), nullable=True)  # YYYY-MM-DD
 
+    client_ref   = db.Column(db.String(64), nullable=True)  # idempotency key terminal (sinkron offline)
+
     customer = db.relationship('Customer')
     item_transaksi = db.relationship("ItemTransaksi", backref="transaksi", cascade="all, delete")
 
 class ItemTransaksi(db.Model):
     __tablename__ = 'item_transaksi'
+    __table_args__ = (
+        db.Index('ix_item_transaksi_transaksi_id', 'transaksi_id'),
+        db.Index('ix_item_transaksi_produk_id', 'produk_id'),
+    )
     id            = db.Column(db.Integer, primary_key=True)
     transaksi_id  = db.Column(db.Integer, db.ForeignKey('transaksi.id'), nullable=False)
     produk_id     = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)
     jumlah        = db.Column(db.Integer, nullable=False)
+    harga_satuan  = db.Column(db.Integer, nullable=False, default=0)  # snapshot harga jual saat checkout
+    hpp_satuan    = db.Column(db.Integer, nullable=False, default=0)  # snapshot HPP saat checkout
     produk = db.relationship("Produk")
 
 class ProdukHarga(db.Model):
     __tablename__ = 'produk_harga'
+    __table_args__ = (
+        db.Index('ix_produk_harga_produk_id', 'produk_id'),
+    )
     id        = db.Column(db.Integer, primary_key=True)
     produk_id = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)
     label     = db.Column(db.String(100), nullable=False)     # "Retail", "Grosir", "Promo"
@@ -147,11 +232,15 @@ class ProdukHarga(db.Model):
 
 class StockMutasi(db.Model):
     __tablename__ = 'stock_mutasi'
+    __table_args__ = (
+        db.Index('ix_stock_mutasi_produk_tanggal', 'produk_id', 'tanggal'),
+        db.Index('ix_stock_mutasi_tanggal', 'tanggal'),
+    )
     id          = db.Column(db.Integer, primary_key=True)
     produk_id   = db.Column(db.Integer, db.ForeignKey('produk.id'), nullable=False)
     tipe        = db.Column(db.String(10), nullable=False)  # 'IN' atau 'OUT'
     qty         = db.Column(db.Integer, nullable=False, default=0)  # positif
-    tanggal     = db.Column(db.String(20), nullable=False)  # 'YYYY-MM-DD'
+    tanggal     = db.Column(TanggalType, nullable=False)    # 'YYYY-MM-DD'
     catatan     = db.Column(db.String(200), nullable=True)
     referensi   = db.Column(db.String(100), nullable=True)  # misal: PO-123, Retur-xxx, dll.
     unit_cost   = db.Column(db.Integer, nullable=True)      # optional biaya per unit (untuk IN)
@@ -160,6 +249,70 @@ class StockMutasi(db.Model):
 
     produk = db.relationship('Produk')
 
+class PenjualanHarian(db.Model):
+    """
+    Rollup penjualan per hari, dipelihara saat checkout (lihat rollup_record_sale).
+    - produk_id = 0 → baris level transaksi: trx, omzet (= Σ total), dibayar, sisa, qty, hpp_cost
+    - produk_id > 0 → baris per produk: qty, omzet (= Σ harga × qty), hpp_cost
+    """
+    __tablename__ = 'penjualan_harian'
+    __table_args__ = (
+        db.UniqueConstraint('tanggal', 'produk_id', 'status', name='uq_penjualan_harian'),
+    )
+    id        = db.Column(db.Integer, primary_key=True)
+    tanggal   = db.Column(db.String(20), nullable=False)                 # 'YYYY-MM-DD'
+    produk_id = db.Column(db.Integer, nullable=False, default=0)         # 0 = level transaksi
+    status    = db.Column(db.String(20), nullable=False, default='LUNAS')
+    trx       = db.Column(db.Integer, nullable=False, default=0)
+    qty       = db.Column(db.Integer, nullable=False, default=0)
+    omzet     = db.Column(db.Integer, nullable=False, default=0)
+    hpp_cost  = db.Column(db.Integer, nullable=False, default=0)
+    dibayar   = db.Column(db.Integer, nullable=False, default=0)
+    sisa      = db.Column(db.Integer, nullable=False, default=0)
+
+class StokSnapshot(db.Model):
+    """
+    Checkpoint stok & HPP per produk pada AKHIR hari `tanggal` (lihat SNAPSHOT STOK).
+    Tanpa FK ke produk: riwayat tetap ada walau produk dihapus.
+    """
+    __tablename__ = 'stok_snapshot'
+    __table_args__ = (
+        db.UniqueConstraint('tanggal', 'produk_id', name='uq_stok_snapshot'),
+    )
+    id        = db.Column(db.Integer, primary_key=True)
+    tanggal   = db.Column(TanggalType, nullable=False)    # 'YYYY-MM-DD'
+    produk_id = db.Column(db.Integer, nullable=False)
+    stok      = db.Column(db.Integer, nullable=False, default=0)
+    hpp       = db.Column(db.Integer, nullable=False, default=0)
+
+class ReportCacheGen(db.Model):
+    """
+    Generasi cache per proses: id=1 data laporan, id=2 katalog (produk/kategori/harga),
+    id=3 resep bertingkat (BOM).
+    Naik setiap ada penulisan yang memengaruhi isi cache tsb.
+    """
+    __tablename__ = 'report_cache_gen'
+    id  = db.Column(db.Integer, primary_key=True)
+    gen = db.Column(db.Integer, nullable=False, default=0)
+
+class PembayaranPiutang(db.Model):
+    """Riwayat pembayaran (cicilan/pelunasan) atas transaksi HUTANG."""
+    __tablename__ = 'pembayaran_piutang'
+    __table_args__ = (
+        db.Index('ix_pembayaran_piutang_transaksi_id', 'transaksi_id'),
+        db.Index('ix_pembayaran_piutang_customer_tanggal', 'customer_id', 'tanggal'),
+    )
+    id           = db.Column(db.Integer, primary_key=True)
+    transaksi_id = db.Column(db.Integer, db.ForeignKey('transaksi.id'), nullable=False)
+    customer_id  = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True)
+    tanggal      = db.Column(db.String(20), nullable=False)  # 'YYYY-MM-DD'
+    jumlah       = db.Column(db.Integer, nullable=False, default=0)
+    catatan      = db.Column(db.String(200), nullable=True)
+    created_at   = db.Column(db.DateTime, server_default=func.now())
+
+    transaksi = db.relationship('Transaksi', backref=db.backref('pembayaran_piutang', order_by='PembayaranPiutang.id'))
+    customer  = db.relationship('Customer')
+
 # ==================== KARYAWAN & PRODUKSI ====================
 
 class Karyawan(db.Model):
@@ -187,8 +340,12 @@ class Pekerjaan(db.Model):
 
 class ProduksiKaryawan(db.Model):
     __tablename__ = 'produksi_karyawan'
+    __table_args__ = (
+        db.Index('ix_produksi_karyawan_karyawan_tanggal', 'karyawan_id', 'tanggal'),
+        db.Index('ix_produksi_karyawan_tanggal', 'tanggal'),
+    )
     id               = db.Column(db.Integer, primary_key=True)
-    tanggal          = db.Column(db.String(20), nullable=False)  # 'YYYY-MM-DD'
+    tanggal          = db.Column(TanggalType, nullable=False)    # 'YYYY-MM-DD'
     karyawan_id      = db.Column(db.Integer, db.ForeignKey('karyawan.id'), nullable=False)
     pekerjaan_id     = db.Column(db.Integer, db.ForeignKey('pekerjaan.id'), nullable=False)
     qty              = db.Column(db.Integer, nullable=False, default=0)
@@ -202,12 +359,108 @@ class ProduksiKaryawan(db.Model):
     karyawan = db.relationship('Karyawan', back_populates='produksi')
     pekerjaan= db.relationship('Pekerjaan', back_populates='produksi')    
 
+# ========== FTS PRODUK ==========
+# Index full-text (SQLite FTS5) atas nama produk + nama kategori, rowid = produk.id.
+# Sinkron lewat trigger → tambah/edit/hapus/impor produk & ganti nama kategori ikut ter-update.
+# Jika SQLite tidak mendukung FTS5, pencarian jatuh ke LIKE (lihat cari_produk).
+FTS_PRODUK = {"aktif": False}
+
+_PRODUK_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS produk_fts USING fts5("
+    "nama, kategori, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS produk_fts_ai AFTER INSERT ON produk BEGIN "
+    "INSERT INTO produk_fts(rowid, nama, kategori) VALUES "
+    "(new.id, new.nama, (SELECT nama FROM kategori WHERE id = new.kategori_id)); END",
+    "CREATE TRIGGER IF NOT EXISTS produk_fts_au AFTER UPDATE OF nama, kategori_id ON produk BEGIN "
+    "DELETE FROM produk_fts WHERE rowid = old.id; "
+    "INSERT INTO produk_fts(rowid, nama, kategori) VALUES "
+    "(new.id, new.nama, (SELECT nama FROM kategori WHERE id = new.kategori_id)); END",
+    "CREATE TRIGGER IF NOT EXISTS produk_fts_ad AFTER DELETE ON produk BEGIN "
+    "DELETE FROM produk_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS kategori_fts_au AFTER UPDATE OF nama ON kategori BEGIN "
+    "DELETE FROM produk_fts WHERE rowid IN (SELECT id FROM produk WHERE kategori_id = new.id); "
+    "INSERT INTO produk_fts(rowid, nama, kategori) "
+    "SELECT id, nama, new.nama FROM produk WHERE kategori_id = new.id; END",
+]
+
+def rebuild_produk_fts(conn):
+    """Isi ulang produk_fts dari tabel produk (sekali saat index baru dibuat / perbaikan)."""
+    conn.execute(text("DELETE FROM produk_fts"))
+    conn.execute(text(
+        "INSERT INTO produk_fts(rowid, nama, kategori) "
+        "SELECT p.id, p.nama, k.nama FROM produk p LEFT JOIN kategori k ON k.id = p.kategori_id"
+    ))
+
+def cari_produk(q, limit=20):
+    """
+    Cari produk: tiap kata jadi prefix match ("bant gul" → bantal guling), diurutkan bm25
+    (nama berbobot lebih besar dari kategori). Return: list Produk (kategori ikut dimuat).
+    """
+    tokens = re.findall(r'\w+', (q or '').lower())
+    if not tokens:
+        return []
+    if FTS_PRODUK["aktif"]:
+        match = ' '.join(f'"{t}"*' for t in tokens)
+        ids = db.session.execute(
+            text("SELECT rowid FROM produk_fts WHERE produk_fts MATCH :m "
+                 "ORDER BY bm25(produk_fts, 10.0, 2.0) LIMIT :n"),
+            {"m": match, "n": limit}
+        ).scalars().all()
+    else:
+        qq = db.session.query(Produk.id)
+        for t in tokens:
+            qq = qq.filter(Produk.nama.ilike(f'%{t}%'))
+        ids = [pid for (pid,) in qq.order_by(Produk.nama.asc()).limit(limit)]
+    if not ids:
+        return []
+    produk = {p.id: p for p in Produk.query.options(joinedload(Produk.kategori)).filter(Produk.id.in_(ids))}
+    return [produk[i] for i in ids if i in produk]
+
 # ========== MIGRASI RINGAN ==========
+def _migrasi_kolom_tanggal(table):
+    """
+    Samakan tipe kolom 'tanggal' di DB dengan opsi TANGGAL_INT (VARCHAR ↔ INTEGER YYYYMMDD).
+    SQLite tidak bisa ALTER tipe kolom → tabel dibangun ulang (index dibuat ulang di akhir migrasi).
+    """
+    insp = inspect(db.engine)
+    old_cols = {c['name']: c for c in insp.get_columns(table.name)}
+    is_int = isinstance(old_cols['tanggal']['type'], Integer)
+    want_int = bool(app.config.get('TANGGAL_INT'))
+    if is_int == want_int:
+        return
+
+    if want_int:
+        conv = "CAST(REPLACE(tanggal, '-', '') AS INTEGER)"
+    else:
+        conv = "substr(tanggal, 1, 4) || '-' || substr(tanggal, 5, 2) || '-' || substr(tanggal, 7, 2)"
+
+    cols = [c.name for c in table.columns if c.name in old_cols]
+    select_cols = ', '.join(conv if c == 'tanggal' else c for c in cols)
+    tmp_name = table.name + '_new'
+    tmp = table.to_metadata(db.metadata, name=tmp_name)
+    tmp.indexes.clear()
+    try:
+        with db.engine.begin() as conn:
+            tmp.create(bind=conn)
+            conn.execute(text(
+                f"INSERT INTO {tmp_name} ({', '.join(cols)}) SELECT {select_cols} FROM {table.name}"
+            ))
+            conn.execute(text(f"DROP TABLE {table.name}"))
+            conn.execute(text(f"ALTER TABLE {tmp_name} RENAME TO {table.name}"))
+    finally:
+        db.metadata.remove(tmp)
+
 with app.app_context():
     db.create_all()
     try:
         insp = inspect(db.engine)
 
+        # ===== Baris generasi cache laporan =====
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT OR IGNORE INTO report_cache_gen (id, gen) VALUES (1, 0)"))
+            conn.execute(text("INSERT OR IGNORE INTO report_cache_gen (id, gen) VALUES (2, 0)"))
+            conn.execute(text("INSERT OR IGNORE INTO report_cache_gen (id, gen) VALUES (3, 0)"))
+
         # ===== Migrasi tabel transaksi =====
         cols_trx = {c['name'] for c in insp.get_columns('transaksi')}
         with db.engine.begin() as conn:
@@ -223,6 +476,60 @@ with app.app_context():
                 conn.execute(text(
                     "ALTER TABLE transaksi ADD COLUMN jatuh_tempo VARCHAR(20)"
                 ))
+            if 'client_ref' not in cols_trx:
+                conn.execute(text(
+                    "ALTER TABLE transaksi ADD COLUMN client_ref VARCHAR(64)"
+                ))
+
+        # ===== Migrasi tabel item_transaksi (snapshot harga & HPP) =====
+        # Baris lama di-backfill dari harga/HPP produk saat migrasi (pendekatan terbaik yang ada)
+        cols_item = {c['name'] for c in insp.get_columns('item_transaksi')}
+        with db.engine.begin() as conn:
+            if 'harga_satuan' not in cols_item:
+                conn.execute(text("ALTER TABLE item_transaksi ADD COLUMN harga_satuan INTEGER DEFAULT 0"))
+                conn.execute(text(
+                    "UPDATE item_transaksi SET harga_satuan = "
+                    "COALESCE((SELECT harga FROM produk WHERE produk.id = item_transaksi.produk_id), 0)"
+                ))
+            if 'hpp_satuan' not in cols_item:
+                conn.execute(text("ALTER TABLE item_transaksi ADD COLUMN hpp_satuan INTEGER DEFAULT 0"))
+                conn.execute(text(
+                    "UPDATE item_transaksi SET hpp_satuan = "
+                    "COALESCE((SELECT hpp FROM produk WHERE produk.id = item_transaksi.produk_id), 0)"
+                ))
+
+        # ===== Migrasi tabel customer (saldo piutang) =====
+        cols_cust = {c['name'] for c in insp.get_columns('customer')}
+        if 'saldo_piutang' not in cols_cust:
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE customer ADD COLUMN saldo_piutang INTEGER DEFAULT 0"))
+                conn.execute(text(
+                    "UPDATE customer SET saldo_piutang = COALESCE(("
+                    "SELECT SUM(sisa) FROM transaksi "
+                    "WHERE transaksi.customer_id = customer.id AND transaksi.status = 'HUTANG'), 0)"
+                ))
+
+        # ===== Migrasi tabel room (waktu tutup) =====
+        if 'closed_at' not in {c['name'] for c in insp.get_columns('room')}:
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE room ADD COLUMN closed_at DATETIME"))
+
+        # ===== Migrasi tabel room_item (versi + unik per room/produk) =====
+        cols_ri = {c['name'] for c in insp.get_columns('room_item')}
+        if 'version' not in cols_ri:
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE room_item ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+                # gabungkan baris ganda (room, produk) sebelum index unik dibuat
+                conn.execute(text(
+                    "UPDATE room_item SET jumlah = (SELECT SUM(r2.jumlah) FROM room_item r2 "
+                    "WHERE r2.room_id = room_item.room_id AND r2.produk_id = room_item.produk_id) "
+                    "WHERE id IN (SELECT MIN(id) FROM room_item GROUP BY room_id, produk_id HAVING COUNT(*) > 1)"
+                ))
+                conn.execute(text(
+                    "DELETE FROM room_item WHERE id NOT IN "
+                    "(SELECT MIN(id) FROM room_item GROUP BY room_id, produk_id)"
+                ))
+                conn.execute(text("DROP INDEX IF EXISTS ix_room_item_room_produk"))
 
         # ===== Migrasi tabel produk =====
         cols_produk = {c['name'] for c in insp.get_columns('produk')}
@@ -232,6 +539,8 @@ with app.app_context():
             if 'is_manufaktur' not in cols_produk:
                 # pakai INTEGER agar aman di SQLite (0/1)
                 conn.execute(text("ALTER TABLE produk ADD COLUMN is_manufaktur INTEGER DEFAULT 0"))
+            if 'barcode' not in cols_produk:
+                conn.execute(text("ALTER TABLE produk ADD COLUMN barcode VARCHAR(64)"))
 
         # ===== Pastikan tabel resep_bahan ada & punya kolom qty =====
         tables = insp.get_table_names()
@@ -276,6 +585,29 @@ with app.app_context():
                     conn.execute(text('DROP TABLE resep_bahan'))
                     conn.execute(text('ALTER TABLE resep_bahan_new RENAME TO resep_bahan'))
 
+        # ===== Tipe kolom tanggal (opsi TANGGAL_INT) =====
+        for tbl in (Transaksi.__table__, StockMutasi.__table__, ProduksiKaryawan.__table__,
+                    StokSnapshot.__table__):
+            _migrasi_kolom_tanggal(tbl)
+
+        # ===== FTS5 pencarian produk =====
+        try:
+            with db.engine.begin() as conn:
+                baru = not conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'produk_fts'")).first()
+                for ddl in _PRODUK_FTS_DDL:
+                    conn.execute(text(ddl))
+                if baru:
+                    rebuild_produk_fts(conn)
+            FTS_PRODUK["aktif"] = True
+        except Exception as e:
+            print("INFO FTS5 tidak tersedia, pencarian produk memakai LIKE:", e)
+
+        # ===== Index (create_all tidak menambah index ke tabel yang sudah ada) =====
+        for tbl in db.metadata.sorted_tables:
+            for ix in tbl.indexes:
+                ix.create(bind=db.engine, checkfirst=True)
+
     except Exception as e:
         print("INFO migrasi (abaikan jika sudah terpasang):", e)
 
@@ -299,89 +631,110 @@ def apply_incoming_hpp(old_stock, old_hpp, in_qty, in_cost):
     except Exception:
         return old_hpp
 
-def produce_manufactured_product(produk_id, qty, tanggal, catatan=None, referensi=None):
+def produce_manufactured_product(produk_id, qty, tanggal, catatan=None, referensi=None, commit=True):
     """
-    Produksi produk manufaktur (produk punya resep_bahan):
-    - Kurangi stok bahan sesuai resep (OUT), kebutuhan = ceil(qty_produksi * qty_per_unit).
-    - Tambah stok produk jadi (IN).
-    - Update HPP produk jadi dengan rata-rata tertimbang dari biaya bahan.
+    Produksi 1 produk manufaktur (produk punya resep_bahan, boleh bertingkat).
+    Pembungkus produksi_batch() dengan satu baris.
     Return: (ok: bool, pesan: str)
     """
-    # Validasi qty
-    try:
-        qty = int(qty or 0)
-    except Exception:
-        return False, "Qty produksi tidak valid."
-    if qty <= 0:
-        return False, "Qty produksi harus lebih dari 0."
-
-    # Ambil produk jadi
-    p = Produk.query.get_or_404(int(produk_id))
-
-    # Resep
-    resep = ResepBahan.query.filter_by(produk_id=p.id).all()
-    if not resep:
-        return False, "Produk ini tidak memiliki resep bahan."
-
-    total_biaya_bahan = 0
-    bahan_ops = []
-
-    # Hitung kebutuhan dan biaya
-    for r in resep:
-        bahan = Produk.query.get(r.bahan_id)
-        if not bahan:
-            return False, f"Bahan dengan ID {r.bahan_id} tidak ditemukan."
-
-        qty_need = qty * float(r.qty or 0.0)           # tanpa waste
-        qty_need_int = int(math.ceil(qty_need))        # stok integer → ceil
-
-        cost_per_unit = int(bahan.hpp or 0)
-        biaya_bahan   = qty_need_int * cost_per_unit
-
-        bahan_ops.append({
-            "bahan": bahan,
-            "qty_out": qty_need_int,
-            "cost_per": cost_per_unit,
-            "biaya": biaya_bahan
-        })
-        total_biaya_bahan += biaya_bahan
-
-    # KURANGI BAHAN (OUT)
-    for op in bahan_ops:
-        b = op["bahan"]
-        b.stok = int((b.stok or 0) - op["qty_out"])
-        db.session.add(StockMutasi(
-            produk_id=b.id,
-            tipe='OUT',
-            qty=op["qty_out"],
-            tanggal=tanggal,
-            catatan=(catatan or f"Produksi {p.nama}"),
-            referensi=(referensi or f"PROD-{p.id}"),
-            unit_cost=op["cost_per"],          # opsional info biaya per unit bahan
-            stok_setelah=b.stok
-        ))
-
-    # TAMBAH STOK PRODUK JADI (IN) + HPP
-    old_stock = int(p.stok or 0)
-    old_hpp   = int(p.hpp or 0)
-    p.stok = old_stock + qty
+    return produksi_batch(
+        [{"produk_id": produk_id, "qty": qty, "catatan": catatan, "referensi": referensi}],
+        tanggal, commit=commit
+    )
 
-    unit_cost_finish = int(round(total_biaya_bahan / qty)) if total_biaya_bahan > 0 else old_hpp
-    p.hpp = apply_incoming_hpp(old_stock, old_hpp, qty, unit_cost_finish)
+def produksi_batch(lines, tanggal, commit=True):
+    """
+    Posting banyak baris produksi dalam SATU transaksi:
+    lines: [{"produk_id", "qty", "catatan"?, "referensi"?}, ...]
+    - Resep di-explode sampai bahan dasar (lihat BOM); sub-rakitan tidak diambil dari stok.
+    - Kebutuhan bahan per baris = ceil(qty * qty_per_unit_flat), dijumlahkan lintas baris.
+    - Stok & HPP dibaca 1 query, ditulis 1 UPDATE (CASE); kartu stok via executemany.
+    - HPP produk jadi: rata-rata tertimbang berurutan per baris (sama seperti posting satu per satu).
+    Satu baris gagal validasi → tidak ada yang ditulis.
+    commit=False → perubahan hanya di sesi; pemanggil yang commit / rollback.
+    Return: (ok: bool, pesan: str)
+    """
+    rencana = []
+    for ln in lines:
+        try:
+            qty = int(ln.get("qty") or 0)
+            pid = int(ln.get("produk_id"))
+        except (TypeError, ValueError):
+            return False, "Qty produksi tidak valid."
+        if qty <= 0:
+            return False, "Qty produksi harus lebih dari 0."
+        rencana.append((pid, qty, ln.get("catatan"), ln.get("referensi")))
+    if not rencana:
+        return False, "Tidak ada baris produksi."
+
+    ok, msg, semua = bom_flat_semua()
+    if not ok:
+        return False, msg
+
+    # Baca stok & HPP semua produk jadi + bahan dasarnya (1 query)
+    ids = {pid for pid, _, _, _ in rencana}
+    for pid in list(ids):
+        ids.update(semua.get(pid, {}))
+    data = {pid: (nama, int(hpp or 0), int(stok or 0)) for pid, nama, hpp, stok in
+            db.session.query(Produk.id, Produk.nama, Produk.hpp, Produk.stok).filter(Produk.id.in_(ids))}
+    for pid, _, _, _ in rencana:
+        if pid not in data:
+            return False, "Produk tidak ditemukan."
+        if not semua.get(pid):
+            return False, f"Produk {data[pid][0]} tidak memiliki resep bahan."
+        hilang = [bid for bid in semua[pid] if bid not in data]
+        if hilang:
+            return False, f"Bahan dengan ID {hilang[0]} tidak ditemukan."
+
+    stok = {pid: d[2] for pid, d in data.items()}
+    hpp  = {pid: d[1] for pid, d in data.items()}
+    mutasi, total_biaya = [], 0
+    for pid, qty, catatan, referensi in rencana:
+        nama_p = data[pid][0]
+        ref = referensi or f"PROD-{pid}"
+        biaya = 0
+        # KURANGI BAHAN (OUT)
+        for bid, per_unit in semua[pid].items():
+            need = int(math.ceil(qty * per_unit - 1e-9))  # stok integer → ceil (toleransi float)
+            if need <= 0:
+                continue
+            stok[bid] -= need
+            biaya += need * hpp[bid]
+            mutasi.append(dict(produk_id=bid, tipe='OUT', qty=need, tanggal=tanggal,
+                               catatan=(catatan or f"Produksi {nama_p}"), referensi=ref,
+                               unit_cost=hpp[bid],            # info biaya per unit bahan
+                               stok_setelah=stok[bid]))
+        # TAMBAH STOK PRODUK JADI (IN) + HPP
+        unit_cost_finish = int(round(biaya / qty)) if biaya > 0 else hpp[pid]
+        hpp[pid] = apply_incoming_hpp(stok[pid], hpp[pid], qty, unit_cost_finish)
+        stok[pid] += qty
+        mutasi.append(dict(produk_id=pid, tipe='IN', qty=qty, tanggal=tanggal,
+                           catatan=(catatan or "Produksi via resep"), referensi=ref,
+                           unit_cost=unit_cost_finish, stok_setelah=stok[pid]))
+        total_biaya += biaya
+
+    # Satu UPDATE: selisih stok (relatif, aman terhadap penjualan paralel) + HPP produk jadi
+    delta = {pid: stok[pid] - data[pid][2] for pid in data if stok[pid] != data[pid][2]}
+    hpp_baru = {pid for pid, _, _, _ in rencana}
+    db.session.execute(
+        update(Produk)
+        .where(Produk.id.in_(delta.keys()))
+        .values(stok=func.coalesce(Produk.stok, 0) + case(delta, value=Produk.id, else_=0),
+                hpp=case({pid: hpp[pid] for pid in hpp_baru}, value=Produk.id, else_=Produk.hpp))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(insert(StockMutasi), mutasi)
 
-    db.session.add(StockMutasi(
-        produk_id=p.id,
-        tipe='IN',
-        qty=qty,
-        tanggal=tanggal,
-        catatan=(catatan or "Produksi via resep"),
-        referensi=(referensi or f"PROD-{p.id}"),
-        unit_cost=unit_cost_finish,
-        stok_setelah=p.stok
-    ))
+    invalidasi_snapshot_stok(tanggal)
+    bump_report_generation()
+    if commit:
+        db.session.commit()
 
-    db.session.commit()
-    return True, f"Produksi {qty} × {p.nama} berhasil. Biaya bahan total: {rupiah_filter(total_biaya_bahan)}"
+    if len(rencana) == 1:
+        pid, qty = rencana[0][0], rencana[0][1]
+        return True, f"Produksi {qty} × {data[pid][0]} berhasil. Biaya bahan total: {rupiah_filter(total_biaya)}"
+    return True, (f"Produksi {len(rencana)} baris ({sum(q for _, q, _, _ in rencana)} unit) berhasil. "
+                  f"Biaya bahan total: {rupiah_filter(total_biaya)}")
 
 def create_stock_mutasi(
     produk_id,
@@ -441,9 +794,651 @@ def create_stock_mutasi(
     )
 
     db.session.add(mut)
+    invalidasi_snapshot_stok(tanggal)
+    bump_report_generation()
     db.session.commit()
     return True, "Mutasi stok tersimpan."
 
+# ========== CACHE LAPORAN ==========
+# Cache hasil laporan per proses, key = (view, start, end, status).
+# Validitas dicek via generasi di tabel report_cache_gen (dibaca 1 query PK per request),
+# sehingga penulisan di worker gunicorn mana pun ikut meng-invalidate cache semua worker.
+REPORT_CACHE_MAX = 64
+_report_cache = {}
+_report_cache_stats = {"hit": 0, "miss": 0}
+
+def bump_report_generation():
+    """Naikkan generasi laporan. Panggil sebelum commit, di session yang sama dengan perubahan data."""
+    db.session.execute(
+        update(ReportCacheGen).where(ReportCacheGen.id == 1).values(gen=ReportCacheGen.gen + 1)
+    )
+
+def current_report_generation():
+    return db.session.query(ReportCacheGen.gen).filter(ReportCacheGen.id == 1).scalar() or 0
+
+def cached_report(view, start_str, end_str, status, builder):
+    """
+    Ambil hasil laporan dari cache jika generasinya masih sama; jika tidak, panggil builder().
+    builder harus mengembalikan data murni (dict/list/angka), bukan objek ORM.
+    """
+    gen = current_report_generation()
+    key = (view, start_str, end_str, status)
+    entry = _report_cache.get(key)
+    if entry is not None and entry[0] == gen:
+        _report_cache_stats["hit"] += 1
+        return entry[1]
+
+    _report_cache_stats["miss"] += 1
+    value = builder()
+    if len(_report_cache) >= REPORT_CACHE_MAX:
+        # buang entry generasi lama dulu; kalau masih penuh, kosongkan
+        for k in [k for k, v in _report_cache.items() if v[0] != gen]:
+            _report_cache.pop(k, None)
+        if len(_report_cache) >= REPORT_CACHE_MAX:
+            _report_cache.clear()
+    _report_cache[key] = (gen, value)
+    return value
+
+# ========== CACHE KATALOG ==========
+# Katalog halaman kasir (produk, kategori, opsi harga + harga_map) dibangun sekali per proses
+# dan dipakai ulang selama generasi katalog (report_cache_gen id=2) belum berubah.
+# Stok TIDAK di-cache (berubah tiap penjualan) → dibaca terpisah per request.
+CATALOG_GEN_ID = 2
+_catalog_cache = {"gen": None, "data": None}
+
+def bump_catalog_generation():
+    """Panggil sebelum commit setiap kali produk/kategori/opsi harga berubah."""
+    db.session.execute(
+        update(ReportCacheGen).where(ReportCacheGen.id == CATALOG_GEN_ID).values(gen=ReportCacheGen.gen + 1)
+    )
+
+def current_catalog_generation():
+    return db.session.query(ReportCacheGen.gen).filter(ReportCacheGen.id == CATALOG_GEN_ID).scalar() or 0
+
+def _build_catalog():
+    """Muat katalog dengan eager loading (3 query total) → snapshot data murni, bukan objek ORM."""
+    produk = (Produk.query
+              .options(selectinload(Produk.harga_list), joinedload(Produk.kategori))
+              .order_by(Produk.id.asc())
+              .all())
+    kategori = [SimpleNamespace(id=k.id, nama=k.nama)
+                for k in Kategori.query.order_by(Kategori.nama.asc()).all()]
+    kat_by_id = {k.id: k for k in kategori}
+
+    daftar, harga_map = [], {}
+    for p in produk:
+        daftar.append(SimpleNamespace(
+            id=p.id, nama=p.nama, harga=p.harga, foto=p.foto,
+            kategori_id=p.kategori_id, kategori=kat_by_id.get(p.kategori_id),
+            is_manufaktur=p.is_manufaktur
+        ))
+        harga_map[p.id] = {
+            "utama": p.harga,
+            "opsi": [{"id": ph.id, "label": ph.label, "harga": ph.harga, "default": ph.is_default}
+                     for ph in p.harga_list]
+        }
+    return {"produk": daftar, "kategori": kategori, "harga_map": harga_map}
+
+def get_catalog():
+    """Katalog dari cache proses (divalidasi 1 query PK generasi), dibangun ulang bila basi."""
+    gen = current_catalog_generation()
+    if _catalog_cache["gen"] != gen or _catalog_cache["data"] is None:
+        _catalog_cache["data"] = _build_catalog()
+        _catalog_cache["gen"] = gen
+    return _catalog_cache["data"]
+
+def get_catalog_json():
+    """(gen, bytes) katalog ringkas untuk grid virtual; diserialisasi sekali per generasi.
+
+    Format: produk = [id, nama, harga, kategori_id, foto], kategori = [id, nama],
+    harga = {produk_id: [[id, label, harga, default], ...]} (hanya produk yang punya opsi).
+    """
+    katalog = get_catalog()
+    gen = _catalog_cache["gen"]
+    if katalog.get("json") is None:
+        doc = {
+            "gen": gen,
+            "kategori": [[k.id, k.nama] for k in katalog["kategori"]],
+            "produk": [[p.id, p.nama, p.harga, p.kategori_id, p.foto] for p in katalog["produk"]],
+            "harga": {str(pid): [[o["id"], o["label"], o["harga"], bool(o["default"])] for o in hm["opsi"]]
+                      for pid, hm in katalog["harga_map"].items() if hm["opsi"]},
+        }
+        katalog["json"] = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return gen, katalog["json"]
+
+# ========== BOM (RESEP BERTINGKAT) ==========
+# Bahan yang punya resep sendiri (sub-rakitan) di-"explode" rekursif sampai bahan dasar
+# (produk tanpa resep). Graf resep dimuat 1 query; kebutuhan bahan dasar per 1 unit tiap
+# produk di-cache per proses, divalidasi generasi resep (report_cache_gen id=3).
+BOM_GEN_ID = 3
+_bom_cache = {"gen": None, "graf": None, "flat": {}}
+
+class SiklusResep(Exception):
+    """Resep saling memakai (A → B → ... → A); `jalur` = daftar produk_id pembentuk siklus."""
+    def __init__(self, jalur):
+        super().__init__(jalur)
+        self.jalur = jalur
+
+def bump_bom_generation():
+    """Panggil sebelum commit setiap kali isi resep_bahan berubah."""
+    db.session.execute(
+        update(ReportCacheGen).where(ReportCacheGen.id == BOM_GEN_ID).values(gen=ReportCacheGen.gen + 1)
+    )
+
+def _bom_load_graf():
+    """{produk_id: [(bahan_id, qty_per_unit), ...]} seluruh resep dalam 1 query."""
+    graf = {}
+    for pid, bid, qty in db.session.query(ResepBahan.produk_id, ResepBahan.bahan_id, ResepBahan.qty):
+        graf.setdefault(pid, []).append((bid, float(qty or 0.0)))
+    return graf
+
+def _bom_explode(pid, graf, flat, jalur):
+    """DFS: kebutuhan bahan dasar per 1 unit `pid` (memo di `flat`); SiklusResep bila ada siklus."""
+    if pid in flat:
+        return flat[pid]
+    if pid in jalur:
+        raise SiklusResep(jalur[jalur.index(pid):] + [pid])
+    jalur.append(pid)
+    hasil = {}
+    for bid, q in graf.get(pid, ()):
+        if q <= 0:
+            continue
+        if bid in graf:
+            for dasar, dq in _bom_explode(bid, graf, flat, jalur).items():
+                hasil[dasar] = hasil.get(dasar, 0.0) + q * dq
+        else:
+            hasil[bid] = hasil.get(bid, 0.0) + q
+    jalur.pop()
+    flat[pid] = hasil
+    return hasil
+
+def _pesan_siklus(jalur):
+    nama = dict(db.session.query(Produk.id, Produk.nama).filter(Produk.id.in_(set(jalur))).all())
+    return "Resep membentuk siklus: " + " → ".join(nama.get(i, f"#{i}") for i in jalur) + "."
+
+def _bom_state():
+    """(graf, memo flat) dari cache proses; dibangun ulang bila generasi resep berubah."""
+    gen = db.session.query(ReportCacheGen.gen).filter(ReportCacheGen.id == BOM_GEN_ID).scalar() or 0
+    if _bom_cache["gen"] != gen or _bom_cache["graf"] is None:
+        _bom_cache["graf"] = _bom_load_graf()
+        _bom_cache["flat"] = {}
+        _bom_cache["gen"] = gen
+    return _bom_cache["graf"], _bom_cache["flat"]
+
+def bom_flat(produk_id):
+    """
+    Kebutuhan bahan dasar per 1 unit produk (dari cache).
+    Return: (ok, pesan, {bahan_id: qty_per_unit}) — dict kosong bila produk tidak punya resep.
+    """
+    graf, flat = _bom_state()
+    try:
+        return True, "", _bom_explode(int(produk_id), graf, flat, [])
+    except SiklusResep as e:
+        return False, _pesan_siklus(e.jalur), {}
+
+def bom_flat_semua():
+    """Kebutuhan bahan dasar per unit untuk SEMUA produk beresep (satu kali jalan DFS ber-memo).
+    Return: (ok, pesan, {produk_id: {bahan_id: qty_per_unit}})"""
+    graf, flat = _bom_state()
+    try:
+        return True, "", {pid: _bom_explode(pid, graf, flat, []) for pid in graf}
+    except SiklusResep as e:
+        return False, _pesan_siklus(e.jalur), {}
+
+def rencana_produksi(rencana):
+    """
+    Perencanaan kebutuhan bahan (MRP) dari stok sekarang — TIDAK menulis apa pun.
+    rencana: {produk_id: qty} (boleh kosong → hanya hitung kapasitas maksimum).
+    Return: (ok, pesan, hasil) dengan hasil:
+      produk    : [{id, nama, stok, maks, qty}] semua produk beresep; maks = unit maksimum
+                  yang bisa dibuat dari stok bahan sekarang (dihitung per produk, sendiri-sendiri)
+      kebutuhan : [{id, nama, stok, butuh, kurang, hpp, biaya_kurang}] agregat bahan dasar rencana
+      cukup     : True bila stok semua bahan cukup untuk seluruh rencana
+    Pembulatan sama dengan produksi: ceil(qty × kebutuhan_per_unit) per produk per bahan.
+    """
+    ok, msg, semua = bom_flat_semua()
+    if not ok:
+        return False, msg, None
+    tanpa_resep = [pid for pid, q in rencana.items() if q > 0 and not semua.get(pid)]
+
+    # Stok/HPP produk beresep + semua bahan dasarnya (1 query)
+    ids = set(semua) | {bid for flat in semua.values() for bid in flat} | set(rencana)
+    info = {pid: (nama, int(stok or 0), int(hpp or 0)) for pid, nama, stok, hpp in
+            db.session.query(Produk.id, Produk.nama, Produk.stok, Produk.hpp).filter(Produk.id.in_(ids))}
+    if tanpa_resep:
+        nama = ", ".join(info.get(pid, (f"#{pid}",))[0] for pid in tanpa_resep)
+        return False, f"Produk tanpa resep tidak bisa direncanakan: {nama}.", None
+
+    produk = []
+    for pid, flat in semua.items():
+        if not flat or pid not in info:
+            continue
+        maks = min(int(max(info.get(bid, ("", 0))[1], 0) / per + 1e-9) for bid, per in flat.items())
+        produk.append({"id": pid, "nama": info[pid][0], "stok": info[pid][1],
+                       "maks": maks, "qty": int(rencana.get(pid) or 0)})
+    produk.sort(key=lambda r: r["nama"].lower())
+
+    butuh = {}
+    for pid, q in rencana.items():
+        if q <= 0:
+            continue
+        for bid, per in semua[pid].items():
+            butuh[bid] = butuh.get(bid, 0) + int(math.ceil(q * per - 1e-9))
+
+    kebutuhan = []
+    for bid, n in butuh.items():
+        nama, stok, hpp = info.get(bid, (f"#{bid}", 0, 0))
+        kurang = max(n - max(stok, 0), 0)
+        kebutuhan.append({"id": bid, "nama": nama, "stok": stok, "butuh": n, "kurang": kurang,
+                          "hpp": hpp, "biaya_kurang": kurang * hpp})
+    kebutuhan.sort(key=lambda r: (-r["kurang"], r["nama"].lower()))
+
+    return True, "", {"produk": produk, "kebutuhan": kebutuhan,
+                      "cukup": all(r["kurang"] == 0 for r in kebutuhan)}
+
+def bom_cek_siklus(produk_id):
+    """Validasi resep yang baru ditulis (belum commit) — tanpa cache. Return: (ok, pesan)."""
+    try:
+        _bom_explode(int(produk_id), _bom_load_graf(), {}, [])
+    except SiklusResep as e:
+        return False, _pesan_siklus(e.jalur)
+    return True, ""
+
+# ========== SNAPSHOT STOK ==========
+# Checkpoint stok+HPP per produk (akhir hari) → stok & nilai persediaan per tanggal D =
+#   checkpoint terdekat ≤ D + pergerakan sesudahnya (stock_mutasi IN/OUT, qty penjualan_harian).
+# Checkpoint dihitung mundur dari stok sekarang (stok_now − Σ pergerakan bertanggal > D), jadi bisa
+# dibuat kapan saja lewat `flask snapshot-stok` (cron). Tanpa checkpoint, laporan tetap jalan:
+# stok per tanggal dihitung mundur dari stok sekarang.
+# POS_SNAPSHOT_STOK=harian (default, checkpoint tiap hari) | bulanan (hanya akhir bulan).
+# Catatan: ubah stok lewat edit/impor produk tidak tercatat di ledger → tidak ikut di-replay.
+SNAPSHOT_STOK_MODE = (os.environ.get('POS_SNAPSHOT_STOK') or 'harian').lower()
+
+def _pergerakan_stok(dari=None, sampai=None):
+    """{produk_id: Δstok} semua pergerakan bertanggal dalam (dari, sampai]; None = tanpa batas."""
+    delta = {}
+    q = db.session.query(StockMutasi.produk_id,
+                         func.sum(case((StockMutasi.tipe == 'IN', StockMutasi.qty), else_=-StockMutasi.qty)))
+    if dari:
+        q = q.filter(StockMutasi.tanggal > dari)
+    if sampai:
+        q = q.filter(StockMutasi.tanggal <= sampai)
+    for pid, d in q.group_by(StockMutasi.produk_id):
+        delta[pid] = int(d or 0)
+
+    q = (db.session.query(PenjualanHarian.produk_id, func.sum(PenjualanHarian.qty))
+         .filter(PenjualanHarian.produk_id != ROLLUP_TRX))
+    if dari:
+        q = q.filter(PenjualanHarian.tanggal > dari)
+    if sampai:
+        q = q.filter(PenjualanHarian.tanggal <= sampai)
+    for pid, n in q.group_by(PenjualanHarian.produk_id):
+        delta[pid] = delta.get(pid, 0) - int(n or 0)
+    return delta
+
+def buat_snapshot_stok(tanggal):
+    """
+    Simpan checkpoint akhir hari `tanggal` (harus < hari ini) dari stok sekarang dikurangi
+    pergerakan setelahnya; HPP = HPP sekarang. Tanpa commit (pemanggil pemilik transaksi).
+    Return: jumlah baris (0 bila sudah ada).
+    """
+    if tanggal >= date.today().strftime("%Y-%m-%d"):
+        raise ValueError("Checkpoint hanya untuk hari yang sudah lewat.")
+    if db.session.query(StokSnapshot.id).filter(StokSnapshot.tanggal == tanggal).first():
+        return 0
+    delta = _pergerakan_stok(dari=tanggal)
+    rows = [{"tanggal": tanggal, "produk_id": pid, "stok": int(stok or 0) - delta.get(pid, 0), "hpp": int(hpp or 0)}
+            for pid, stok, hpp in db.session.query(Produk.id, Produk.stok, Produk.hpp)]
+    if rows:
+        db.session.execute(insert(StokSnapshot), rows)
+    return len(rows)
+
+def tanggal_snapshot_terakhir(today=None):
+    """Checkpoint yang seharusnya sudah ada: kemarin (harian) / akhir bulan lalu (bulanan)."""
+    today = today or date.today()
+    if SNAPSHOT_STOK_MODE == 'bulanan':
+        d = today.replace(day=1) - timedelta(days=1)
+    else:
+        d = today - timedelta(days=1)
+    return d.strftime("%Y-%m-%d")
+
+def invalidasi_snapshot_stok(tanggal):
+    """Pergerakan backdate membuat checkpoint ≥ tanggal basi → hapus (tanpa commit, ikut transaksi pemanggil)."""
+    if tanggal and str(tanggal) < date.today().strftime("%Y-%m-%d"):
+        db.session.execute(delete(StokSnapshot).where(StokSnapshot.tanggal >= tanggal))
+
+def stok_per_tanggal(tanggal):
+    """
+    Stok & HPP tiap produk pada akhir hari `tanggal`: {produk_id: (stok, hpp | None)}.
+    Mulai dari checkpoint terdekat ≤ tanggal lalu terapkan pergerakan sesudahnya (maju);
+    tanpa checkpoint itu → mundur dari checkpoint terdekat sesudahnya, atau dari stok sekarang.
+    HPP mengikuti acuan (checkpoint / sekarang); None bila produk belum ada di acuan.
+    """
+    sebelum = (db.session.query(func.max(StokSnapshot.tanggal))
+               .filter(StokSnapshot.tanggal <= tanggal).scalar())
+    if sebelum:
+        acuan = db.session.query(StokSnapshot.produk_id, StokSnapshot.stok, StokSnapshot.hpp) \
+                          .filter(StokSnapshot.tanggal == sebelum)
+        delta, arah = _pergerakan_stok(dari=sebelum, sampai=tanggal), 1
+    else:
+        sesudah = (db.session.query(func.min(StokSnapshot.tanggal))
+                   .filter(StokSnapshot.tanggal > tanggal).scalar())
+        if sesudah:
+            acuan = db.session.query(StokSnapshot.produk_id, StokSnapshot.stok, StokSnapshot.hpp) \
+                              .filter(StokSnapshot.tanggal == sesudah)
+            delta = _pergerakan_stok(dari=tanggal, sampai=sesudah)
+        else:
+            acuan = db.session.query(Produk.id, Produk.stok, Produk.hpp)
+            delta = _pergerakan_stok(dari=tanggal)
+        arah = -1
+
+    hasil = {pid: (int(stok or 0) + arah * delta.get(pid, 0), int(hpp or 0)) for pid, stok, hpp in acuan}
+    for pid, d in delta.items():
+        if pid not in hasil:
+            hasil[pid] = (arah * d, None)
+    return hasil
+
+def nilai_stok_per_kategori(tanggal):
+    """
+    Nilai persediaan akhir hari `tanggal` per Kategori (stok minus dihitung 0).
+    Return: (baris [{kategori_id, nama, produk, qty, nilai}], per_produk {produk_id: (stok, hpp, nilai)})
+    """
+    stok = stok_per_tanggal(tanggal)
+    info = {pid: (kid, nk, hpp) for pid, kid, nk, hpp in
+            db.session.query(Produk.id, Produk.kategori_id, Kategori.nama, Produk.hpp)
+            .outerjoin(Kategori, Kategori.id == Produk.kategori_id)}
+    per_kat, per_produk = {}, {}
+    for pid, (s, hpp) in stok.items():
+        kid, nk, hpp_now = info.get(pid, (None, None, 0))
+        hpp = hpp_now if hpp is None else hpp
+        qty = max(s, 0)
+        nilai = qty * int(hpp or 0)
+        per_produk[pid] = (s, hpp, nilai)
+        r = per_kat.setdefault(kid, {"kategori_id": kid, "nama": nk or "Tanpa Kategori",
+                                     "produk": 0, "qty": 0, "nilai": 0})
+        r["produk"] += 1
+        r["qty"] += qty
+        r["nilai"] += nilai
+    baris = sorted(per_kat.values(), key=lambda r: -r["nilai"])
+    return baris, per_produk
+
+# ========== ROLLUP PENJUALAN HARIAN ==========
+ROLLUP_TRX = 0  # produk_id untuk baris level transaksi di penjualan_harian
+ROLLUP_COLS = ('trx', 'qty', 'omzet', 'hpp_cost', 'dibayar', 'sisa')
+
+def _sisa_expr():
+    """Ekspresi SQL sisa per transaksi = max(0, total - bayar)."""
+    raw = func.coalesce(Transaksi.total, 0) - func.coalesce(Transaksi.bayar, 0)
+    return case((raw > 0, raw), else_=0)
+
+def _status_filter(q, status):
+    """Terapkan filter status laporan (all|lunas|hutang) di sisi SQL."""
+    if status == 'hutang':
+        return q.filter(_sisa_expr() > 0)
+    if status == 'lunas':
+        return q.filter(_sisa_expr() == 0)
+    return q
+
+def _trx_cost_subquery():
+    """Subquery per transaksi: HPP cost = Σ(qty × hpp_satuan snapshot) dan Σ qty item."""
+    return (db.session.query(
+                ItemTransaksi.transaksi_id.label('transaksi_id'),
+                func.sum(ItemTransaksi.jumlah * ItemTransaksi.hpp_satuan).label('hpp_cost'),
+                func.sum(ItemTransaksi.jumlah).label('qty'))
+            .group_by(ItemTransaksi.transaksi_id)
+            .subquery())
+
+def _rollup_upsert(rows):
+    """
+    Tambahkan (increment) nilai ke penjualan_harian; baris dibuat jika belum ada.
+    rows: list dict {tanggal, produk_id, status, trx, qty, omzet, hpp_cost, dibayar, sisa}
+    Dijalankan di session aktif → ikut commit/rollback transaksi pemanggil.
+    """
+    if not rows:
+        return
+    tbl = PenjualanHarian.__table__
+    stmt = sqlite_insert(tbl)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['tanggal', 'produk_id', 'status'],
+        set_={c: tbl.c[c] + stmt.excluded[c] for c in ROLLUP_COLS}
+    )
+    params = []
+    for r in rows:
+        p = {c: int(r.get(c) or 0) for c in ROLLUP_COLS}
+        p.update(tanggal=r["tanggal"], produk_id=r["produk_id"], status=r["status"])
+        params.append(p)
+    db.session.execute(stmt, params)
+
+def rollup_record_sale(trx, lines, sign=1):
+    """
+    Catat satu transaksi ke rollup harian.
+    lines: list (produk_id, jumlah, harga_satuan, hpp_satuan)
+    sign=-1 untuk membatalkan kontribusi transaksi (mis. saat status berubah).
+    """
+    qty_total = sum(int(j or 0) for _, j, _, _ in lines)
+    hpp_total = sum(int(j or 0) * int(h or 0) for _, j, _, h in lines)
+    rows = [{
+        "tanggal": trx.tanggal, "produk_id": ROLLUP_TRX, "status": trx.status,
+        "trx": sign, "qty": sign * qty_total,
+        "omzet": sign * int(trx.total or 0), "hpp_cost": sign * hpp_total,
+        "dibayar": sign * int(trx.bayar or 0), "sisa": sign * int(trx.sisa or 0),
+    }]
+    for pid, jumlah, harga, hpp in lines:
+        jumlah = int(jumlah or 0)
+        rows.append({
+            "tanggal": trx.tanggal, "produk_id": pid, "status": trx.status,
+            "qty": sign * jumlah,
+            "omzet": sign * jumlah * int(harga or 0),
+            "hpp_cost": sign * jumlah * int(hpp or 0),
+        })
+    _rollup_upsert(rows)
+
+def rollup_record_payment(trx, old_status, old_bayar, old_sisa):
+    """
+    Sesuaikan rollup setelah pembayaran piutang (trx sudah berisi bayar/sisa/status baru).
+    Status tetap → cukup geser dibayar/sisa di baris level transaksi;
+    status berubah (HUTANG → LUNAS) → kontribusi lama dibatalkan lalu dicatat ulang.
+    """
+    if old_status == trx.status:
+        _rollup_upsert([{
+            "tanggal": trx.tanggal, "produk_id": ROLLUP_TRX, "status": trx.status,
+            "dibayar": int(trx.bayar or 0) - int(old_bayar or 0),
+            "sisa": int(trx.sisa or 0) - int(old_sisa or 0),
+        }])
+        return
+
+    lines = [(it.produk_id, it.jumlah, it.harga_satuan, it.hpp_satuan) for it in trx.item_transaksi]
+    lama = SimpleNamespace(tanggal=trx.tanggal, status=old_status, total=trx.total,
+                           bayar=old_bayar, sisa=old_sisa)
+    rollup_record_sale(lama, lines, sign=-1)
+    rollup_record_sale(trx, lines)
+
+def rebuild_penjualan_harian(start_str=None, end_str=None):
+    """
+    Hitung ulang penjualan_harian dari transaksi & item_transaksi (backfill).
+    Range opsional (YYYY-MM-DD); tanpa range → seluruh data.
+    Status mengikuti sisa (sisa > 0 → HUTANG), sama seperti filter laporan.
+    """
+    def in_range(q, col):
+        if start_str:
+            q = q.filter(col >= start_str)
+        if end_str:
+            q = q.filter(col <= end_str)
+        return q
+
+    in_range(PenjualanHarian.query, PenjualanHarian.tanggal).delete(synchronize_session=False)
+
+    status_expr = case((_sisa_expr() > 0, 'HUTANG'), else_='LUNAS')
+    cost_sq = _trx_cost_subquery()
+
+    q_trx = in_range(db.session.query(
+                Transaksi.tanggal, status_expr,
+                func.count(Transaksi.id),
+                func.coalesce(func.sum(cost_sq.c.qty), 0),
+                func.coalesce(func.sum(Transaksi.total), 0),
+                func.coalesce(func.sum(cost_sq.c.hpp_cost), 0),
+                func.coalesce(func.sum(Transaksi.bayar), 0),
+                func.coalesce(func.sum(_sisa_expr()), 0))
+            .outerjoin(cost_sq, cost_sq.c.transaksi_id == Transaksi.id),
+            Transaksi.tanggal).group_by(Transaksi.tanggal, status_expr)
+
+    rows = []
+    for tgl, st, n, qty, omzet, hpp_cost, dibayar, sisa in q_trx.all():
+        rows.append({"tanggal": tgl, "produk_id": ROLLUP_TRX, "status": st, "trx": n, "qty": qty,
+                     "omzet": omzet, "hpp_cost": hpp_cost, "dibayar": dibayar, "sisa": sisa})
+
+    q_item = in_range(db.session.query(
+                 Transaksi.tanggal, status_expr, ItemTransaksi.produk_id,
+                 func.coalesce(func.sum(ItemTransaksi.jumlah), 0),
+                 func.coalesce(func.sum(ItemTransaksi.jumlah * ItemTransaksi.harga_satuan), 0),
+                 func.coalesce(func.sum(ItemTransaksi.jumlah * ItemTransaksi.hpp_satuan), 0))
+             .join(ItemTransaksi, ItemTransaksi.transaksi_id == Transaksi.id),
+             Transaksi.tanggal).group_by(Transaksi.tanggal, status_expr, ItemTransaksi.produk_id)
+
+    for tgl, st, pid, qty, omzet, hpp_cost in q_item.all():
+        rows.append({"tanggal": tgl, "produk_id": pid, "status": st,
+                     "qty": qty, "omzet": omzet, "hpp_cost": hpp_cost})
+
+    _rollup_upsert(rows)
+    bump_report_generation()
+    db.session.commit()
+    return len(rows)
+
+@app.cli.command('rebuild-rollup')
+@click.option('--start', default=None, help='Tanggal awal YYYY-MM-DD (opsional)')
+@click.option('--end', default=None, help='Tanggal akhir YYYY-MM-DD (opsional)')
+def rebuild_rollup_command(start, end):
+    """Backfill / hitung ulang tabel penjualan_harian."""
+    n = rebuild_penjualan_harian(start, end)
+    click.echo(f"Rollup penjualan_harian: {n} baris ditulis.")
+
+# Backfill otomatis sekali saat tabel rollup baru dibuat pada database lama
+with app.app_context():
+    try:
+        if PenjualanHarian.query.first() is None and Transaksi.query.first() is not None:
+            rebuild_penjualan_harian()
+    except Exception as e:
+        db.session.rollback()
+        print("INFO rollup penjualan_harian:", e)
+
+# ========== PIUTANG (HUTANG PELANGGAN) ==========
+AGING_BUCKETS = ('belum', '0-30', '31-60', '61-90', '90+')
+
+def piutang_tambah(customer_id, jumlah):
+    """Tambah/kurangi saldo piutang customer secara atomik (UPDATE saldo = saldo + ?)."""
+    if not customer_id or not jumlah:
+        return
+    db.session.execute(
+        update(Customer).where(Customer.id == customer_id)
+        .values(saldo_piutang=func.coalesce(Customer.saldo_piutang, 0) + int(jumlah))
+    )
+
+def bayar_piutang(trx, jumlah, tanggal, catatan=None):
+    """
+    Catat pembayaran atas transaksi HUTANG: bayar += jumlah, sisa -= jumlah (maks. sisa),
+    status jadi LUNAS jika sisa habis; saldo customer & rollup ikut diperbarui.
+    Sisa diubah dengan SATU UPDATE bersyarat (status HUTANG & sisa cukup) → dua pembayaran
+    bersamaan tidak bisa sama-sama memakai sisa lama.
+    Return: (ok: bool, pesan: str)
+    """
+    try:
+        jumlah = int(jumlah or 0)
+    except Exception:
+        return False, "Nominal pembayaran tidak valid."
+    if jumlah <= 0:
+        return False, "Nominal pembayaran harus lebih dari 0."
+    if trx.status != 'HUTANG' or int(trx.sisa or 0) <= 0:
+        return False, "Transaksi ini tidak memiliki sisa hutang."
+
+    dipakai = min(jumlah, int(trx.sisa or 0))
+    res = db.session.execute(
+        update(Transaksi)
+        .where(Transaksi.id == trx.id, Transaksi.status == 'HUTANG', Transaksi.sisa >= dipakai)
+        .values(bayar=func.coalesce(Transaksi.bayar, 0) + dipakai,
+                sisa=Transaksi.sisa - dipakai,
+                status=case((Transaksi.sisa - dipakai == 0, 'LUNAS'), else_=Transaksi.status))
+        .execution_options(synchronize_session=False)
+    )
+    if res.rowcount == 0:
+        db.session.rollback()
+        return False, "Sisa hutang sudah berubah (ada pembayaran lain). Muat ulang lalu coba lagi."
+
+    # Nilai lama diturunkan dari hasil UPDATE (bukan dari objek yang mungkin basi)
+    db.session.refresh(trx)
+    old_status, old_bayar, old_sisa = 'HUTANG', int(trx.bayar or 0) - dipakai, int(trx.sisa or 0) + dipakai
+
+    db.session.add(PembayaranPiutang(
+        transaksi_id=trx.id, customer_id=trx.customer_id, tanggal=tanggal,
+        jumlah=dipakai, catatan=(catatan or '').strip() or None
+    ))
+    piutang_tambah(trx.customer_id, -dipakai)
+    rollup_record_payment(trx, old_status, old_bayar, old_sisa)
+    bump_report_generation()
+    db.session.commit()
+
+    msg = f"Pembayaran {rupiah_filter(dipakai)} tercatat."
+    if trx.status == 'LUNAS':
+        msg += " Transaksi LUNAS."
+    else:
+        msg += f" Sisa: {rupiah_filter(trx.sisa)}"
+    if jumlah > dipakai:
+        msg += f" (Kelebihan {rupiah_filter(jumlah - dipakai)} tidak dicatat.)"
+    return True, msg
+
+def aging_piutang(today: date = None):
+    """
+    Umur piutang per customer dihitung di SQL (GROUP BY customer, bucket).
+    Bucket dari hari lewat jatuh tempo (tanpa jatuh tempo → dihitung dari tanggal transaksi):
+      'belum' (belum lewat jatuh tempo, termasuk jatuh tempo hari ini), '0-30', '31-60', '61-90', '90+'.
+    Return: list dict per customer {customer_id, nama, total, nota, <bucket>: nominal} urut total desc.
+    """
+    today = today or date.today()
+    batas = [(today - timedelta(days=d)).strftime("%Y-%m-%d") for d in (0, 30, 60, 90)]
+
+    def bucket_of(col):
+        return case(
+            (col >= batas[0], 'belum'),
+            (col >= batas[1], '0-30'),
+            (col >= batas[2], '31-60'),
+            (col >= batas[3], '61-90'),
+            else_='90+'
+        )
+
+    bucket = case(
+        (Transaksi.jatuh_tempo.isnot(None), bucket_of(Transaksi.jatuh_tempo)),
+        else_=bucket_of(Transaksi.tanggal)
+    )
+    q = (db.session.query(Transaksi.customer_id, Customer.nama, bucket,
+                          func.sum(Transaksi.sisa), func.count(Transaksi.id))
+         .outerjoin(Customer, Customer.id == Transaksi.customer_id)
+         .filter(Transaksi.status == 'HUTANG', Transaksi.sisa > 0)
+         .group_by(Transaksi.customer_id, Customer.nama, bucket))
+
+    per_cust = {}
+    for cid, nama, b, nominal, nota in q.all():
+        row = per_cust.setdefault(cid, {"customer_id": cid, "nama": nama or "(Tanpa pelanggan)",
+                                        "total": 0, "nota": 0, **{k: 0 for k in AGING_BUCKETS}})
+        row[b] += int(nominal or 0)
+        row["total"] += int(nominal or 0)
+        row["nota"] += int(nota or 0)
+    return sorted(per_cust.values(), key=lambda r: r["total"], reverse=True)
+
+def rebuild_saldo_piutang():
+    """Hitung ulang Customer.saldo_piutang dari transaksi HUTANG (perbaikan data)."""
+    sub = (db.session.query(func.coalesce(func.sum(Transaksi.sisa), 0))
+           .filter(Transaksi.customer_id == Customer.id, Transaksi.status == 'HUTANG')
+           .correlate(Customer)
+           .scalar_subquery())
+    db.session.execute(update(Customer).values(saldo_piutang=sub))
+    bump_report_generation()
+    db.session.commit()
+
+@app.cli.command('rebuild-piutang')
+def rebuild_piutang_command():
+    """Hitung ulang saldo piutang semua customer."""
+    rebuild_saldo_piutang()
+    click.echo("Saldo piutang customer dihitung ulang.")
+
 # ==================== UTIL & FILTER ====================
 def get_default_price(produk: 'Produk'):
     if not produk:
@@ -480,36 +1475,64 @@ def gen_room_code(n=6):
 def ensure_room():
     return session.get('room_code')
 
+# Room & keranjang di-memo per request pada flask.g (context processor + handler
+# tidak perlu query ulang). Setelah mengubah isi keranjang → invalidate_cart_cache().
 def get_current_room():
     code = session.get('room_code')
     if not code:
         return None
-    return Room.query.filter_by(kode=code, status='open').first()
+    if g.get('_room_code') != code:
+        g._room_code = code
+        g._room = Room.query.filter_by(kode=code, status='open').first()
+    return g._room
+
+def invalidate_cart_cache():
+    """Buang memo room/keranjang request ini (panggil setelah keranjang/room berubah)."""
+    for k in ('_room_code', '_room', '_cart', '_cart_count'):
+        g.pop(k, None)
 
 def get_cart_dict_for_template():
     room = get_current_room()
-    result = {}
-    if room:
-        items = RoomItem.query.filter_by(room_id=room.id).all()
-        for it in items:
-            p = Produk.query.get(it.produk_id)
-            if p:
-                result[str(p.id)] = {
-                    "nama": p.nama,
-                    "harga": it.harga if it.harga else p.harga,
-                    "jumlah": it.jumlah,
-                    "foto": p.foto,
-                    "stok": p.stok
-                }
-        return result
-    else:
+    if not room:
         return session.get('cart', {})
+    if g.get('_cart') is None:
+        rows = (db.session.query(RoomItem.produk_id, RoomItem.jumlah, RoomItem.harga, RoomItem.version,
+                                 Produk.nama, Produk.harga, Produk.foto, Produk.stok, Produk.hpp)
+                .join(Produk, Produk.id == RoomItem.produk_id)
+                .filter(RoomItem.room_id == room.id)
+                .order_by(RoomItem.id.asc())
+                .all())
+        g._cart = {
+            str(pid): {
+                "nama": nama,
+                "harga": harga_item if harga_item else harga_produk,
+                "jumlah": jumlah,
+                "foto": foto,
+                "stok": stok,
+                "hpp": hpp,
+                "versi": versi
+            }
+            for pid, jumlah, harga_item, versi, nama, harga_produk, foto, stok, hpp in rows
+        }
+    return g._cart
+
+def get_cart_count():
+    """Total qty di keranjang; mode room cukup SUM(jumlah) tanpa membangun seluruh keranjang."""
+    room = get_current_room()
+    if not room:
+        return sum(item.get("jumlah", 0) for item in session.get('cart', {}).values())
+    if g.get('_cart') is not None:
+        return sum(item.get("jumlah", 0) for item in g._cart.values())
+    if g.get('_cart_count') is None:
+        g._cart_count = int(db.session.query(func.coalesce(func.sum(RoomItem.jumlah), 0))
+                            .join(Produk, Produk.id == RoomItem.produk_id)
+                            .filter(RoomItem.room_id == room.id).scalar() or 0)
+    return g._cart_count
 
 @app.context_processor
 def inject_globals():
     room = get_current_room()
-    cart = get_cart_dict_for_template()
-    count = sum(item.get("jumlah", 0) for item in cart.values())
+    count = get_cart_count()
     try:
         ep = request.endpoint
     except Exception:
@@ -520,25 +1543,55 @@ def inject_globals():
 @app.route("/")
 def index():
     ensure_room()
-    daftar_produk   = Produk.query.all()
-    daftar_kategori = Kategori.query.order_by(Kategori.nama.asc()).all()
-    daftar_rooms    = Room.query.filter_by(status='open').order_by(Room.created_at.desc()).all()
-
-    harga_map = {}
-    for p in daftar_produk:
-        options = []
-        for ph in p.harga_list:
-            options.append({"id": ph.id, "label": ph.label, "harga": ph.harga, "default": ph.is_default})
-        harga_map[p.id] = {"utama": p.harga, "opsi": options}
+    katalog      = get_catalog()
+    daftar_rooms = Room.query.filter_by(status='open').order_by(Room.created_at.desc()).all()
+
+    mode = request.args.get("grid")
+    grid_virtual = mode == "virtual" or (app.config['GRID_VIRTUAL'] and mode != "biasa")
+    if grid_virtual:
+        # Kartu produk, harga_map & stok dimuat browser dari /api/katalog (+ /api/katalog/stok)
+        return render_template(
+            "index.html",
+            grid_virtual=True,
+            daftar_produk=[],
+            daftar_kategori=katalog["kategori"],
+            daftar_rooms=daftar_rooms,
+            harga_map={},
+            stok_map={}
+        )
 
+    stok_map = dict(db.session.query(Produk.id, Produk.stok).all())
     return render_template(
         "index.html",
-        daftar_produk=daftar_produk,
-        daftar_kategori=daftar_kategori,
+        grid_virtual=False,
+        daftar_produk=katalog["produk"],
+        daftar_kategori=katalog["kategori"],
         daftar_rooms=daftar_rooms,
-        harga_map=harga_map
+        harga_map=katalog["harga_map"],
+        stok_map=stok_map
     )
 
+@app.route("/api/katalog", endpoint="api_katalog")
+def api_katalog():
+    """Katalog ringkas ber-ETag (generasi katalog); browser revalidasi → 304 bila tidak berubah."""
+    gen, body = get_catalog_json()
+    etag = f"katalog-{gen}"
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/api/katalog/stok", endpoint="api_katalog_stok")
+def api_katalog_stok():
+    """Stok terkini [[id, stok], ...] — terpisah dari katalog karena berubah tiap penjualan."""
+    rows = db.session.query(Produk.id, Produk.stok).order_by(Produk.id.asc()).all()
+    resp = jsonify({"stok": [[pid, stok or 0] for pid, stok in rows]})
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
 # ==================== KERANJANG ====================
 @app.route("/tambah_keranjang", methods=["POST"])
 def tambah_keranjang():
@@ -552,31 +1605,43 @@ def tambah_keranjang():
         return redirect(url_for("index"))
 
     p = Produk.query.get_or_404(int(produk_id))
+    keranjang_tambah(p, qty, resolve_harga_snap(p, harga_id, harga_manual))
 
-    snap_price = None
+    flash(f"{p.nama} x{qty} ditambahkan ke keranjang.", "success")
+    return redirect(url_for("index"))
+
+def resolve_harga_snap(p, harga_id=None, harga_manual=None):
+    """Harga yang dibekukan ke keranjang: manual (>0) → preset ProdukHarga → harga default."""
     if harga_manual:
         try:
             hm = int(harga_manual)
             if hm > 0:
-                snap_price = hm
+                return hm
         except:
             pass
-    if snap_price is None and harga_id and harga_id.isdigit():
+    if harga_id and str(harga_id).isdigit():
         ph = ProdukHarga.query.get(int(harga_id))
         if ph and ph.produk_id == p.id:
-            snap_price = ph.harga
-    if snap_price is None:
-        snap_price = get_default_price(p)
+            return ph.harga
+    return get_default_price(p)
 
+def keranjang_tambah(p, qty, snap_price):
+    """Tambah qty produk ke keranjang aktif (room → RoomItem + commit, selain itu session)."""
     room = get_current_room()
     if room:
-        it = RoomItem.query.filter_by(room_id=room.id, produk_id=p.id).first()
-        if it:
-            it.jumlah += qty
-            it.harga = snap_price
-        else:
-            db.session.add(RoomItem(room_id=room.id, produk_id=p.id, jumlah=qty, harga=snap_price))
+        # upsert atomik: perangkat lain yang menambah produk sama tidak saling menimpa
+        tbl = RoomItem.__table__
+        stmt = sqlite_insert(tbl).values(room_id=room.id, produk_id=p.id, jumlah=qty,
+                                         harga=snap_price, version=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['room_id', 'produk_id'],
+            set_={"jumlah": tbl.c.jumlah + stmt.excluded.jumlah,
+                  "harga": stmt.excluded.harga,
+                  "version": tbl.c.version + 1}
+        )
+        db.session.execute(stmt)
         db.session.commit()
+        invalidate_cart_cache()
     else:
         cart = session.get('cart', {})
         key = str(p.id)
@@ -588,8 +1653,65 @@ def tambah_keranjang():
         session['cart'] = cart
         session.modified = True
 
-    flash(f"{p.nama} x{qty} ditambahkan ke keranjang.", "success")
-    return redirect(url_for("index"))
+KERANJANG_OK, KERANJANG_TIDAK_ADA, KERANJANG_KONFLIK = 'ok', 'tidak_ada', 'konflik'
+
+def keranjang_ubah(pid, qty=None, harga=None, versi=None):
+    """
+    Ubah satu baris keranjang: qty=0 → hapus, qty>0 → set jumlah, harga (opsional) → set harga.
+    Mode room: satu UPDATE/DELETE atomik; bila versi diberikan → compare-and-swap
+    (hanya berhasil jika baris belum diubah perangkat lain sejak dibaca).
+    Return: KERANJANG_OK | KERANJANG_TIDAK_ADA | KERANJANG_KONFLIK
+    """
+    room = get_current_room()
+    if room:
+        cond = [RoomItem.room_id == room.id, RoomItem.produk_id == int(pid)]
+        if versi is not None:
+            cond.append(RoomItem.version == int(versi))
+        if qty == 0:
+            stmt = delete(RoomItem).where(*cond)
+        else:
+            vals = {"version": RoomItem.version + 1}
+            if qty is not None:
+                vals["jumlah"] = qty
+            if harga is not None:
+                vals["harga"] = harga
+            stmt = update(RoomItem).where(*cond).values(**vals)
+        res = db.session.execute(stmt.execution_options(synchronize_session=False))
+        if res.rowcount == 0:
+            ada = db.session.query(RoomItem.id).filter(*cond[:2]).first()
+            return KERANJANG_KONFLIK if ada else KERANJANG_TIDAK_ADA
+        db.session.commit()
+        invalidate_cart_cache()
+        return KERANJANG_OK
+
+    cart = session.get('cart', {})
+    key = str(pid)
+    if key not in cart:
+        return KERANJANG_TIDAK_ADA
+    if qty == 0:
+        cart.pop(key, None)
+    else:
+        if qty is not None:
+            cart[key]["jumlah"] = qty
+        if harga is not None:
+            cart[key]["harga"] = harga
+    session['cart'] = cart
+    session.modified = True
+    return KERANJANG_OK
+
+def keranjang_kosongkan():
+    """Batalkan keranjang: room ditutup (item dihapus), atau keranjang session dibuang."""
+    room = get_current_room()
+    if room:
+        RoomItem.query.filter_by(room_id=room.id).delete()
+        room.status = 'closed'
+        room.closed_at = func.now()
+        db.session.commit()
+        session.pop('room_code', None)
+        invalidate_cart_cache()
+    else:
+        session.pop('cart', None)
+        session.modified = True
 
 def to_int_safely(val, default=0):
     """Konversi aman ke int dari berbagai input."""
@@ -614,22 +1736,20 @@ def to_int_safely(val, default=0):
 @app.route("/keranjang", endpoint="keranjang_view")
 def keranjang_view():
     cart = get_cart_dict_for_template()
-    room = get_current_room()
 
-    # Kalau mode session (bukan room), tambahkan info stok terbaru untuk ditampilkan
-    if not room:
-        for pid, item in cart.items():
-            p = Produk.query.get(int(pid))
-            item["stok"] = p.stok if p else 0
+    # Stok terbaru & HPP semua produk keranjang dalam SATU query (mode session maupun room)
+    pids = [int(pid) for pid in cart if str(pid).isdigit()]
+    info = {}
+    if pids:
+        info = {str(pid): (stok, hpp) for pid, stok, hpp in
+                db.session.query(Produk.id, Produk.stok, Produk.hpp).filter(Produk.id.in_(pids))}
 
     # Map HPP per produk (key = string pid agar match dengan cart)
     produk_hpp = {}
     for pid, item in cart.items():
-        try:
-            p = Produk.query.get(int(pid))
-            produk_hpp[pid] = int(p.hpp or 0) if p else 0
-        except:
-            produk_hpp[pid] = 0
+        stok, hpp = info.get(pid, (0, 0))
+        item["stok"] = stok or 0
+        produk_hpp[pid] = int(hpp or 0)
 
     # Helper aman: ubah harga ke int meskipun inputnya string dgn titik/koma
     def as_int(x):
@@ -677,55 +1797,36 @@ def keranjang_view():
 
 @app.route("/keranjang/update", methods=["POST"])
 def keranjang_update():
-    room   = get_current_room()
     keys   = request.form.getlist("key[]")
     qtys   = request.form.getlist("qty[]") or request.form.getlist("jumlah[]")
     prices = request.form.getlist("price[]")
+    versis = request.form.getlist("versi[]")
 
-    if room:
-        for key, q, h in zip(keys, qtys, prices):
-            pid  = int(key)
-            q_int = max(0, int(q or 0))
-            h_int = max(0, int(h or 0)) if (h is not None and h != "") else None
-            it = RoomItem.query.filter_by(room_id=room.id, produk_id=pid).first()
-            if it:
-                if q_int == 0:
-                    db.session.delete(it)
-                else:
-                    it.jumlah = q_int
-                    if h_int is not None:
-                        it.harga = h_int
-        db.session.commit()
-    else:
-        cart = session.get('cart', {})
-        for key, q, h in zip(keys, qtys, prices):
-            q_int = max(0, int(q or 0))
-            h_int = max(0, int(h or 0)) if (h is not None and h != "") else None
-            if key in cart:
-                if q_int == 0:
-                    cart.pop(key, None)
-                else:
-                    cart[key]["jumlah"] = q_int
-                    if h_int is not None:
-                        cart[key]["harga"] = h_int
-        session['cart'] = cart
-        session.modified = True
-
+    cart = get_cart_dict_for_template()
+    konflik = []
+    for i, (key, q, h) in enumerate(zip(keys, qtys, prices)):
+        if key not in cart:
+            continue
+        q_int = max(0, int(q or 0))
+        h_int = max(0, int(h or 0)) if (h is not None and h != "") else None
+        # baris yang tidak diubah dilewati → tidak menimpa/konflik dengan perangkat lain
+        if q_int == cart[key]["jumlah"] and h_int in (None, cart[key]["harga"]):
+            continue
+        v = versis[i] if i < len(versis) and str(versis[i]).isdigit() else None
+        nama = cart[key]["nama"]
+        if keranjang_ubah(key, q_int, h_int, versi=v) == KERANJANG_KONFLIK:
+            konflik.append(nama)
+
+    if konflik:
+        flash("Diubah perangkat lain, periksa lalu ulangi: " + ", ".join(konflik), "error")
     return redirect(url_for("keranjang_view"))
 
 @app.route("/keranjang/hapus/<pid>", methods=["POST"], endpoint="hapus_item_keranjang")
 def keranjang_hapus(pid):
-    room = get_current_room()
-    if room:
-        it = RoomItem.query.filter_by(room_id=room.id, produk_id=int(pid)).first()
-        if it:
-            db.session.delete(it)
-            db.session.commit()
-    else:
-        cart = session.get('cart', {})
-        cart.pop(pid, None)
-        session['cart'] = cart
-        session.modified = True
+    if str(pid).isdigit():
+        versi = request.form.get("versi")
+        if keranjang_ubah(pid, 0, versi=int(versi) if str(versi or "").isdigit() else None) == KERANJANG_KONFLIK:
+            flash("Item diubah perangkat lain, periksa lalu ulangi.", "error")
     return redirect(url_for("keranjang_view"))
 
 @app.route("/keranjang/update_price", methods=["POST"])
@@ -743,42 +1844,201 @@ def keranjang_update_price():
         flash("Harga tidak valid.", "error")
         return redirect(url_for("keranjang_view"))
 
-    room = get_current_room()
-    if room:
-        it = RoomItem.query.filter_by(room_id=room.id, produk_id=int(key)).first()
-        if it:
-            it.harga = harga_int
-            db.session.commit()
-        else:
-            flash("Item tidak ditemukan di keranjang room.", "error")
+    versi = request.form.get("versi")
+    hasil = keranjang_ubah(key, harga=harga_int, versi=int(versi) if str(versi or "").isdigit() else None)
+    if hasil == KERANJANG_TIDAK_ADA:
+        flash("Item tidak ditemukan di keranjang.", "error")
+    elif hasil == KERANJANG_KONFLIK:
+        flash("Item diubah perangkat lain, periksa lalu ulangi.", "error")
     else:
-        cart = session.get('cart', {})
-        if key in cart:
-            cart[key]["harga"] = harga_int
-            session['cart'] = cart
-            session.modified = True
-        else:
-            flash("Item tidak ditemukan di keranjang.", "error")
-
-    flash("Harga berhasil diperbarui.", "success")
+        flash("Harga berhasil diperbarui.", "success")
     return redirect(url_for("keranjang_view"))
 
 @app.route("/keranjang/clear", methods=["POST"])
 def keranjang_clear():
-    room = get_current_room()
-    if room:
-        RoomItem.query.filter_by(room_id=room.id).delete()
-        room.status = 'closed'
-        db.session.commit()
-        session.pop('room_code', None)
-    else:
-        session.pop('cart', None)
-        session.modified = True
-
+    keranjang_kosongkan()
     flash("Keranjang telah dibatalkan.", "info")
     return redirect(url_for("index"))
 
+# ========== API KERANJANG (JSON) ==========
+# Untuk kasir/scanner: ubah keranjang tanpa reload halaman katalog.
+# Body boleh form-encoded atau JSON; respons hanya baris yang berubah + total baru.
+def _api_data():
+    return request.get_json(silent=True) or request.form
+
+def _api_keranjang_resp(pid=None, msg=None, status=200):
+    cart = get_cart_dict_for_template()
+    line = None
+    if pid is not None and str(pid) in cart:
+        it = cart[str(pid)]
+        line = {"produk_id": int(pid), "nama": it.get("nama"), "harga": int(it.get("harga") or 0),
+                "jumlah": int(it.get("jumlah") or 0), "versi": it.get("versi"),
+                "subtotal": int(it.get("harga") or 0) * int(it.get("jumlah") or 0)}
+    total = sum(int(it.get("harga") or 0) * int(it.get("jumlah") or 0) for it in cart.values())
+    return jsonify({
+        "ok": status < 400,
+        "msg": msg,
+        "produk_id": int(pid) if pid is not None else None,
+        "line": line,
+        "cart_count": sum(int(it.get("jumlah") or 0) for it in cart.values()),
+        "total": total,
+    }), status
+
+def _api_error(msg, status=400):
+    return jsonify({"ok": False, "msg": msg}), status
+
+def _api_versi(data):
+    """Versi baris (RoomItem.version) yang dibaca klien; kosong → tanpa compare-and-swap."""
+    v = data.get("versi")
+    return int(v) if str(v or "").isdigit() else None
+
+def _api_keranjang_hasil(pid, hasil, msg):
+    if hasil == KERANJANG_TIDAK_ADA:
+        return _api_error("Item tidak ditemukan di keranjang.", 404)
+    if hasil == KERANJANG_KONFLIK:
+        # 409 + baris terbaru → klien memperbarui tampilan lalu mengulang dengan versi baru
+        return _api_keranjang_resp(pid, "Item diubah perangkat lain, silakan ulangi.", 409)
+    return _api_keranjang_resp(pid, msg)
+
+@app.route("/api/keranjang/tambah", methods=["POST"], endpoint="api_keranjang_tambah")
+def api_keranjang_tambah():
+    data = _api_data()
+    pid = to_int_safely(data.get("produk_id"))
+    qty = to_int_safely(data.get("jumlah") or data.get("qty"))
+    barcode = (data.get("barcode") or "").strip()
+    if (pid <= 0 and not barcode) or qty <= 0:
+        return _api_error("Jumlah tidak valid.")
+    if barcode:
+        p = Produk.query.filter_by(barcode=barcode).first()
+    else:
+        p = db.session.get(Produk, pid)
+    if not p:
+        return _api_error("Produk tidak ditemukan.", 404)
+    keranjang_tambah(p, qty, resolve_harga_snap(p, data.get("harga_id"), data.get("harga_manual")))
+    return _api_keranjang_resp(p.id, f"{p.nama} x{qty} ditambahkan ke keranjang.")
+
+@app.route("/api/keranjang/update", methods=["POST"], endpoint="api_keranjang_update")
+def api_keranjang_update():
+    data = _api_data()
+    pid = to_int_safely(data.get("produk_id"))
+    raw_qty, raw_harga = data.get("jumlah", data.get("qty")), data.get("harga")
+    qty   = max(0, to_int_safely(raw_qty)) if raw_qty not in (None, "") else None
+    harga = max(0, to_int_safely(raw_harga)) if raw_harga not in (None, "") else None
+    if pid <= 0 or (qty is None and harga is None):
+        return _api_error("Data tidak valid.")
+    return _api_keranjang_hasil(pid, keranjang_ubah(pid, qty, harga, versi=_api_versi(data)),
+                                "Keranjang diperbarui.")
+
+@app.route("/api/keranjang/hapus/<int:pid>", methods=["POST"], endpoint="api_keranjang_hapus")
+def api_keranjang_hapus(pid):
+    return _api_keranjang_hasil(pid, keranjang_ubah(pid, 0, versi=_api_versi(_api_data())),
+                                "Item dihapus dari keranjang.")
+
+@app.route("/api/keranjang/clear", methods=["POST"], endpoint="api_keranjang_clear")
+def api_keranjang_clear():
+    keranjang_kosongkan()
+    return _api_keranjang_resp(None, "Keranjang telah dibatalkan.")
+
 # ==================== PEMBAYARAN ====================
+def kurangi_stok_checkout(cart, tolak_minus=None):
+    """
+    Kurangi stok semua produk di keranjang dengan SATU UPDATE bersyarat:
+      UPDATE produk SET stok = stok - CASE id WHEN .. THEN .. END
+      WHERE id IN (..) [AND stok >= CASE ..]
+    Atomik terhadap kasir lain (tidak ada read-modify-write di Python).
+    tolak_minus=True → gagal bila ada stok yang akan minus (rowcount < jumlah produk).
+    Keranjang room sudah membawa nama/hpp/stok dari join get_cart_dict_for_template
+    → dipakai langsung; keranjang session/sinkron dibaca dengan satu query.
+    Return: (ok: bool, pesan: str, produk: {id: (nama, hpp, stok_awal)})
+    """
+    if tolak_minus is None:
+        tolak_minus = app.config['TOLAK_STOK_MINUS']
+
+    kebutuhan = {}
+    for pid, item in cart.items():
+        if str(pid).isdigit() and int(item.get("jumlah") or 0) > 0:
+            kebutuhan[int(pid)] = kebutuhan.get(int(pid), 0) + int(item["jumlah"])
+    if not kebutuhan:
+        return False, "Keranjang kosong.", {}
+
+    if all("hpp" in item and "stok" in item for item in cart.values()):
+        produk = {int(pid): (item["nama"], item["hpp"], item["stok"])
+                  for pid, item in cart.items() if int(pid) in kebutuhan}
+    else:
+        produk = {pid: (nama, hpp, stok) for pid, nama, hpp, stok in
+                  db.session.query(Produk.id, Produk.nama, Produk.hpp, Produk.stok)
+                  .filter(Produk.id.in_(kebutuhan.keys()))}
+    kebutuhan = {pid: q for pid, q in kebutuhan.items() if pid in produk}
+    if not kebutuhan:
+        return False, "Produk di keranjang sudah tidak tersedia.", {}
+
+    qty_case = case(kebutuhan, value=Produk.id, else_=0)
+    stmt = (update(Produk)
+            .where(Produk.id.in_(kebutuhan.keys()))
+            .values(stok=func.coalesce(Produk.stok, 0) - qty_case)
+            .execution_options(synchronize_session=False))
+    if tolak_minus:
+        stmt = stmt.where(func.coalesce(Produk.stok, 0) >= qty_case)
+
+    res = db.session.execute(stmt)
+    if res.rowcount != len(kebutuhan):
+        kurang = [produk[pid][0] for pid, q in kebutuhan.items() if int(produk[pid][2] or 0) < q]
+        return False, "Stok tidak cukup: " + (", ".join(kurang) or "produk berubah, coba lagi") + ".", produk
+    return True, "", {pid: produk[pid] for pid in kebutuhan}
+
+def hitung_status_bayar(total, bayar, is_hutang):
+    """
+    Tentukan status pembayaran.
+    Return: (ok, pesan, status, sisa, kembalian)
+    """
+    if bayar >= total:
+        return True, "", 'LUNAS', 0, bayar - total
+    if is_hutang:
+        return True, "", 'HUTANG', total - bayar, 0
+    return False, "Nominal bayar kurang dari total untuk transaksi LUNAS.", 'LUNAS', 0, 0
+
+def catat_transaksi(lines, produk, tanggal, total, bayar, status, sisa, kembalian,
+                    customer_id=None, jatuh_tempo=None, client_ref=None):
+    """
+    Simpan header + item transaksi, rollup harian & saldo piutang (tanpa commit).
+    Stok TIDAK diubah di sini (lihat kurangi_stok_checkout).
+    lines: list (produk_id, jumlah, harga_satuan); produk: {id: (nama, hpp, stok)}.
+    """
+    trx = Transaksi(
+        tanggal=tanggal,
+        total=total,
+        customer_id=customer_id,
+        bayar=bayar,
+        kembalian=kembalian,
+        status=status,
+        sisa=sisa,
+        jatuh_tempo=jatuh_tempo if (status == 'HUTANG' and jatuh_tempo) else None,
+        client_ref=client_ref
+    )
+    db.session.add(trx)
+    db.session.flush()
+
+    # Item transaksi: satu INSERT executemany (snapshot harga & HPP saat jual)
+    item_rows, rollup_lines = [], []
+    for pid, jumlah, harga in lines:
+        if pid not in produk:
+            continue
+        hpp = int(produk[pid][1] or 0)
+        item_rows.append({
+            "transaksi_id": trx.id, "produk_id": pid, "jumlah": jumlah,
+            "harga_satuan": harga, "hpp_satuan": hpp,
+        })
+        rollup_lines.append((pid, jumlah, harga, hpp))
+    if item_rows:
+        db.session.execute(insert(ItemTransaksi), item_rows)
+        invalidasi_snapshot_stok(tanggal)  # sinkron offline bisa bertanggal mundur
+
+    # Rollup harian & saldo piutang ikut di transaksi yang sama (commit bersama)
+    rollup_record_sale(trx, rollup_lines)
+    if status == 'HUTANG':
+        piutang_tambah(customer_id, sisa)
+    return trx
+
 @app.route("/pembayaran", methods=["GET", "POST"])
 def pembayaran():
     cart = get_cart_dict_for_template()
@@ -798,57 +2058,38 @@ def pembayaran():
             flash("Transaksi hutang harus memilih pelanggan.", "error")
             return redirect(url_for("pembayaran"))
 
-        status = 'LUNAS'
-        sisa   = 0
-        kembalian = 0
-
-        if is_hutang:
-            if bayar >= total:
-                status = 'LUNAS'
-                sisa   = 0
-                kembalian = bayar - total
-            else:
-                status = 'HUTANG'
-                sisa   = total - bayar
-                kembalian = 0
-        else:
-            if bayar < total:
-                flash("Nominal bayar kurang dari total untuk transaksi LUNAS.", "error")
-                return redirect(url_for("pembayaran"))
-            kembalian = bayar - total
-            sisa = 0
-            status = 'LUNAS'
-
-        tgl = datetime.now().strftime("%Y-%m-%d")
-        trx = Transaksi(
-            tanggal=tgl,
-            total=total,
+        ok, msg, status, sisa, kembalian = hitung_status_bayar(total, bayar, is_hutang)
+        if not ok:
+            flash(msg, "error")
+            return redirect(url_for("pembayaran"))
+
+        ok, msg, produk = kurangi_stok_checkout(cart)
+        if not ok:
+            db.session.rollback()
+            flash(msg, "error")
+            return redirect(url_for("keranjang_view"))
+
+        trx = catat_transaksi(
+            [(int(pid), item["jumlah"], item["harga"]) for pid, item in cart.items()],
+            produk,
+            tanggal=datetime.now().strftime("%Y-%m-%d"),
+            total=total, bayar=bayar, status=status, sisa=sisa, kembalian=kembalian,
             customer_id=int(customer_id) if customer_id and customer_id.isdigit() else None,
-            bayar=bayar,
-            kembalian=kembalian,
-            status=status,
-            sisa=sisa,
-            jatuh_tempo=jatuh_tempo if (is_hutang and sisa > 0 and jatuh_tempo) else None
+            jatuh_tempo=jatuh_tempo
         )
-        db.session.add(trx)
-        db.session.flush()
-
-        for pid, item in cart.items():
-            p = Produk.query.get(int(pid))
-            if not p:
-                continue
-            p.stok -= item["jumlah"]
-            db.session.add(ItemTransaksi(transaksi_id=trx.id, produk_id=p.id, jumlah=item["jumlah"]))
+        bump_report_generation()
 
         room = get_current_room()
         if room:
             room.status = 'closed'
+            room.closed_at = func.now()
             db.session.commit()
             session.pop('room_code', None)
         else:
             db.session.commit()
 
         session.pop("cart", None)
+        invalidate_cart_cache()
 
         if status == 'HUTANG':
             flash(f"Transaksi TERSIMPAN sebagai HUTANG. Sisa: {rupiah_filter(sisa)}", "success")
@@ -860,105 +2101,498 @@ def pembayaran():
     customers = Customer.query.order_by(Customer.nama.asc()).all()
     return render_template("pembayaran.html", total=total, customers=customers)
 
-# ==================== LAPORAN & ANALITIK ====================
-def compute_laporan_periodik(start_str: str, end_str: str, status: str):
+# ========== SINKRON PENJUALAN OFFLINE (TERMINAL) ==========
+SYNC_MAX_PENJUALAN = 500   # batas penjualan per batch
+
+def _parse_penjualan_offline(raw, harga_default):
     """
-    Hitung ringkasan + daftar transaksi (drill-down) untuk laporan periodik.
-    Tambahan: perhitungan Laba (approx) = total - Σ(qty * HPP produk saat ini).
+    Validasi satu penjualan offline.
+    raw: {idempotency_key, waktu|tanggal, items:[{produk_id, jumlah, harga?}], bayar, status, customer_id?, jatuh_tempo?}
+    Return: (dict penjualan | None, pesan error)
     """
-    def sisa_of(t):
-        bayar = t.bayar or 0
-        return max(0, (t.total or 0) - bayar)
-
-    # Ambil transaksi pada range tanggal (kolom tanggal = string 'YYYY-MM-DD')
-    q = (Transaksi.query
-         .filter(Transaksi.tanggal >= start_str,
-                 Transaksi.tanggal <= end_str)
-         .order_by(Transaksi.id.desc())
-         .options(
-             joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk),
-             joinedload(Transaksi.customer)
-         ))
+    if not isinstance(raw, dict):
+        return None, "Penjualan harus berupa objek."
+    key = str(raw.get("idempotency_key") or "").strip()
+    if not key or len(key) > 64:
+        return None, "idempotency_key wajib (maks. 64 karakter)."
 
-    trx_all = q.all()
+    tgl = str(raw.get("waktu") or raw.get("tanggal") or "")[:10]
+    try:
+        datetime.strptime(tgl, "%Y-%m-%d")
+    except ValueError:
+        return None, "waktu/tanggal tidak valid (YYYY-MM-DD...)."
+
+    items = raw.get("items") or []
+    if not isinstance(items, list):
+        return None, "items harus berupa list."
+    lines = []
+    for it in items:
+        if not isinstance(it, dict):
+            return None, "Item penjualan harus berupa objek."
+        pid, qty = to_int_safely(it.get("produk_id")), to_int_safely(it.get("jumlah"))
+        if pid not in harga_default:
+            return None, f"Produk #{pid} tidak ditemukan."
+        if qty <= 0:
+            return None, "Jumlah item harus lebih dari 0."
+        harga = to_int_safely(it.get("harga"), default=-1)
+        lines.append((pid, qty, harga if harga >= 0 else harga_default[pid]))
+    if not lines:
+        return None, "Penjualan tanpa item."
+
+    total = sum(q * h for _, q, h in lines)
+    is_hutang = str(raw.get("status") or "").upper() == 'HUTANG'
+    ok, msg, status, sisa, kembalian = hitung_status_bayar(total, to_int_safely(raw.get("bayar")), is_hutang)
+    if not ok:
+        return None, msg
+    customer_id = to_int_safely(raw.get("customer_id")) or None
+    if status == 'HUTANG' and not customer_id:
+        return None, "Transaksi hutang harus memilih pelanggan."
+    jatuh_tempo = str(raw.get("jatuh_tempo") or "").strip() or None
+    if jatuh_tempo:
+        try:
+            datetime.strptime(jatuh_tempo, "%Y-%m-%d")
+        except ValueError:
+            return None, "jatuh_tempo tidak valid (YYYY-MM-DD)."
 
-    # Filter status
-    if status == 'hutang':
-        trx_filtered = [t for t in trx_all if sisa_of(t) > 0]
-    elif status == 'lunas':
-        trx_filtered = [t for t in trx_all if sisa_of(t) == 0]
-    else:
-        trx_filtered = trx_all
+    return {
+        "key": key, "tanggal": tgl, "lines": lines, "total": total,
+        "bayar": to_int_safely(raw.get("bayar")), "status": status, "sisa": sisa,
+        "kembalian": kembalian, "customer_id": customer_id,
+        "jatuh_tempo": jatuh_tempo,
+    }, ""
+
+@app.route('/api/penjualan/sync', methods=['POST'], endpoint='api_penjualan_sync')
+def api_penjualan_sync():
+    """
+    Terima batch penjualan yang sudah terjadi di terminal (offline) dan simpan dalam SATU transaksi DB.
+    Idempoten per idempotency_key: kunci yang sudah tersimpan dilaporkan sebagai 'duplikat', tidak diposting ulang.
+    Satu penjualan tidak valid → seluruh batch ditolak (400) agar terminal bisa memperbaiki antrean.
+    Stok semua penjualan dikurangi dengan satu UPDATE (penjualan sudah terjadi → stok boleh minus).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return _api_error("Body harus berupa objek JSON.")
+    batch = data.get("penjualan")
+    if not isinstance(batch, list) or not batch:
+        return _api_error("Field 'penjualan' (list) wajib diisi.")
+    if len(batch) > SYNC_MAX_PENJUALAN:
+        return _api_error(f"Maksimal {SYNC_MAX_PENJUALAN} penjualan per batch.", 413)
+
+    keys = [str(raw.get("idempotency_key") or "").strip() if isinstance(raw, dict) else "" for raw in batch]
+    sudah = dict(db.session.query(Transaksi.client_ref, Transaksi.id)
+                 .filter(Transaksi.client_ref.in_([k for k in keys if k])))
+
+    pids = {to_int_safely(it.get("produk_id"))
+            for raw in batch if isinstance(raw, dict) and isinstance(raw.get("items"), list)
+            for it in raw["items"] if isinstance(it, dict)}
+    harga_default = {p.id: get_default_price(p) for p in
+                     Produk.query.options(selectinload(Produk.harga_list)).filter(Produk.id.in_(pids))}
+
+    penjualan, duplikat, errors, dilihat = [], [], [], set()
+    for i, raw in enumerate(batch):
+        key = keys[i]
+        if key and (key in sudah or key in dilihat):
+            duplikat.append({"idempotency_key": key, "transaksi_id": sudah.get(key)})
+            continue
+        pj, msg = _parse_penjualan_offline(raw, harga_default)
+        if not pj:
+            errors.append({"index": i, "idempotency_key": key or None, "msg": msg})
+            continue
+        dilihat.add(key)
+        penjualan.append(pj)
+
+    cust_ids = {pj["customer_id"] for pj in penjualan if pj["customer_id"]}
+    if cust_ids:
+        ada = {cid for (cid,) in db.session.query(Customer.id).filter(Customer.id.in_(cust_ids))}
+        for pj in penjualan:
+            if pj["customer_id"] and pj["customer_id"] not in ada:
+                errors.append({"idempotency_key": pj["key"], "msg": f"Customer #{pj['customer_id']} tidak ditemukan."})
+    if errors:
+        return jsonify({"ok": False, "msg": "Batch ditolak, tidak ada yang disimpan.", "errors": errors}), 400
+
+    diterima = []
+    if penjualan:
+        gabungan = {}
+        for pj in penjualan:
+            for pid, qty, _ in pj["lines"]:
+                gabungan.setdefault(str(pid), {"jumlah": 0})["jumlah"] += qty
+        try:
+            _, _, produk = kurangi_stok_checkout(gabungan, tolak_minus=False)
+            for pj in penjualan:
+                trx = catat_transaksi(pj["lines"], produk, pj["tanggal"], pj["total"], pj["bayar"],
+                                      pj["status"], pj["sisa"], pj["kembalian"],
+                                      customer_id=pj["customer_id"], jatuh_tempo=pj["jatuh_tempo"],
+                                      client_ref=pj["key"])
+                diterima.append({"idempotency_key": pj["key"], "transaksi_id": trx.id, "status": trx.status})
+            bump_report_generation()
+            db.session.commit()
+        except IntegrityError:
+            # Batch yang sama dikirim bersamaan (flush di catat_transaksi / commit kena ux_transaksi_client_ref)
+            # → batalkan semua, laporkan kunci yang kini sudah tersimpan; kirim ulang sisanya.
+            db.session.rollback()
+            bentrok = (db.session.query(Transaksi.client_ref, Transaksi.id)
+                       .filter(Transaksi.client_ref.in_([pj["key"] for pj in penjualan])))
+            duplikat += [{"idempotency_key": k, "transaksi_id": tid} for k, tid in bentrok]
+            return jsonify({"ok": False, "msg": "Konflik idempotency_key, tidak ada yang disimpan. Kirim ulang batch.",
+                            "duplikat": duplikat}), 409
+
+    return jsonify({"ok": True, "diterima": diterima, "duplikat": duplikat})
 
-    # Ringkasan
-    total_trx       = len(trx_filtered)
-    total_penjualan = sum((t.total or 0) for t in trx_filtered)
-    total_dibayar   = sum((t.bayar or 0) for t in trx_filtered)
-    total_sisa      = sum(sisa_of(t) for t in trx_filtered)
+# ==================== LAPORAN & ANALITIK ====================
+def _rollup_filter(q, start_str, end_str, status):
+    """Filter range tanggal + status (all|lunas|hutang) pada query penjualan_harian."""
+    PH = PenjualanHarian
+    q = q.filter(PH.tanggal >= start_str, PH.tanggal <= end_str)
+    if status in ('lunas', 'hutang'):
+        q = q.filter(PH.status == status.upper())
+    return q
+
+def _rollup_sums():
+    """Kolom SUM standar rollup (urutan: trx, qty, omzet, hpp_cost, dibayar, sisa)."""
+    PH = PenjualanHarian
+    return [func.sum(getattr(PH, c)).label(c) for c in ROLLUP_COLS]
+
+def _daily_row(trx, qty, omzet, hpp_cost, dibayar, sisa):
+    return {
+        "trx": int(trx or 0),
+        "omzet": int(omzet or 0),
+        "hpp_cost": int(hpp_cost or 0),
+        "laba": int(omzet or 0) - int(hpp_cost or 0),
+        "dibayar": int(dibayar or 0),
+        "sisa": int(sisa or 0),
+        "qty": int(qty or 0),
+    }
 
-    # HPP cost & laba (approx)
-    total_hpp_cost  = 0
-    total_item_terjual = 0
+def _fill_daily_series(per_hari, start_str, end_str):
+    """Susun seri harian urut tanggal; hari tanpa transaksi diisi 0."""
+    kosong = _daily_row(0, 0, 0, 0, 0, 0)
+    try:
+        cur = datetime.strptime(start_str, "%Y-%m-%d").date()
+        end = datetime.strptime(end_str, "%Y-%m-%d").date()
+    except Exception:
+        # format tanggal tak dikenal → kembalikan hari yang ada saja
+        return [{"tanggal": t, "label": t, **v} for t, v in sorted(per_hari.items())]
 
-    drill_rows = []
-    for t in trx_filtered:
-        # agregasi item per transaksi
-        trx_cost_hpp = 0
-        trx_item_count = 0
-        for it in t.item_transaksi:
-            qty = it.jumlah or 0
-            p = it.produk
-            hpp_now = int(p.hpp or 0) if p else 0
-            trx_cost_hpp += (hpp_now * qty)
-            trx_item_count += qty
+    series = []
+    while cur <= end:
+        d_s = cur.strftime("%Y-%m-%d")
+        series.append({"tanggal": d_s, "label": cur.strftime("%d/%m"), **per_hari.get(d_s, kosong)})
+        cur += timedelta(days=1)
+    return series
 
-        trx_laba = (t.total or 0) - trx_cost_hpp
-        total_hpp_cost += trx_cost_hpp
-        total_item_terjual += trx_item_count
+def daily_sales_aggregate(start_str: str, end_str: str, status: str = 'all'):
+    """
+    Agregasi penjualan per hari untuk range tanggal dalam SATU query GROUP BY
+    atas rollup penjualan_harian (baris level transaksi).
+    Return: list dict urut tanggal, hari tanpa transaksi tetap ada (nilai 0):
+      {tanggal, label, trx, omzet, hpp_cost, laba, dibayar, sisa, qty}
+    """
+    PH = PenjualanHarian
+    q = _rollup_filter(db.session.query(PH.tanggal, *_rollup_sums())
+                       .filter(PH.produk_id == ROLLUP_TRX), start_str, end_str, status)
+    q = q.group_by(PH.tanggal)
+
+    per_hari = {tgl: _daily_row(*vals) for tgl, *vals in q.all()}
+    return _fill_daily_series(per_hari, start_str, end_str)
+
+def sum_daily_series(series):
+    """Jumlahkan list hasil daily_sales_aggregate menjadi satu ringkasan."""
+    keys = ("trx", "omzet", "hpp_cost", "laba", "dibayar", "sisa", "qty")
+    return {k: sum(row[k] for row in series) for k in keys}
+
+TOP_PRODUK_URUTAN = ('qty', 'omzet', 'laba')
+
+def _top_produk_order(by):
+    PH = PenjualanHarian
+    if by == 'omzet':
+        return func.sum(PH.omzet)
+    if by == 'laba':
+        return func.sum(PH.omzet) - func.sum(PH.hpp_cost)
+    return func.sum(PH.qty)
+
+def _top_produk_subquery(start_str, end_str, status, n, by='qty'):
+    """Subquery top-N produk (urut qty/omzet/laba) dari baris per produk di penjualan_harian."""
+    PH = PenjualanHarian
+    q = _rollup_filter(db.session.query(PH.produk_id.label('produk_id'), *_rollup_sums())
+                       .filter(PH.produk_id != ROLLUP_TRX), start_str, end_str, status)
+    return (q.group_by(PH.produk_id)
+             .order_by(_top_produk_order(by).desc())
+             .limit(n)
+             .subquery())
+
+def top_produk(start_str: str, end_str: str, by: str = 'qty', n: int = 5, status: str = 'all'):
+    """
+    Top-N produk periode: GROUP BY produk_id ... ORDER BY <by> LIMIT n di rollup penjualan_harian.
+    by: 'qty' | 'omzet' | 'laba'. Biaya bergantung jumlah produk, bukan jumlah item transaksi.
+    Return: list dict {produk_id, nama, kategori, qty, omzet, hpp_cost, laba}
+    """
+    if by not in TOP_PRODUK_URUTAN:
+        by = 'qty'
+    sq = _top_produk_subquery(start_str, end_str, status, n, by)
+    q = (db.session.query(sq.c.produk_id, Produk.nama, Kategori.nama,
+                          sq.c.qty, sq.c.omzet, sq.c.hpp_cost)
+         .outerjoin(Produk, Produk.id == sq.c.produk_id)
+         .outerjoin(Kategori, Kategori.id == Produk.kategori_id))
+    hasil = []
+    for pid, nama, kat, qty, omzet, hpp_cost in q.all():
+        omzet = int(omzet or 0)
+        hpp_cost = int(hpp_cost or 0)
+        hasil.append({
+            "produk_id": pid,
+            "nama": nama or f"Produk #{pid}",
+            "kategori": kat or "-",
+            "qty": int(qty or 0),
+            "omzet": omzet,
+            "hpp_cost": hpp_cost,
+            "laba": omzet - hpp_cost,
+        })
+    hasil.sort(key=lambda x: x[by], reverse=True)
+    return hasil
 
-        sisa = sisa_of(t)
-        status_lbl = "HUTANG" if sisa > 0 else "LUNAS"
-        drill_rows.append({
-            "id": t.id,
-            "tanggal": t.tanggal,
-            "customer": (t.customer.nama if t.customer else "-"),
-            "total": t.total or 0,
-            "hpp_cost": trx_cost_hpp,
-            "laba": trx_laba,
-            "bayar": t.bayar or 0,
-            "sisa": sisa,
-            "status": status_lbl
+def margin_per_kategori(start_str: str, end_str: str, status: str = 'all'):
+    """
+    Omzet, HPP, laba & margin (%) per Kategori untuk periode (GROUP BY kategori di SQL).
+    Produk tanpa kategori & penjualan produk yang sudah dihapus (outer join, seperti top_produk)
+    dikelompokkan sebagai '(Tanpa kategori / produk dihapus)' → total tetap sama dengan omzet periode.
+    """
+    PH = PenjualanHarian
+    q = _rollup_filter(
+        db.session.query(Kategori.id, Kategori.nama,
+                         func.sum(PH.qty), func.sum(PH.omzet), func.sum(PH.hpp_cost))
+        .select_from(PH)
+        .outerjoin(Produk, Produk.id == PH.produk_id)
+        .outerjoin(Kategori, Kategori.id == Produk.kategori_id)
+        .filter(PH.produk_id != ROLLUP_TRX), start_str, end_str, status)
+    q = q.group_by(Kategori.id, Kategori.nama).order_by(func.sum(PH.omzet).desc())
+
+    hasil = []
+    for kid, nama, qty, omzet, hpp_cost in q.all():
+        omzet = int(omzet or 0)
+        laba = omzet - int(hpp_cost or 0)
+        hasil.append({
+            "kategori_id": kid,
+            "nama": nama or "(Tanpa kategori / produk dihapus)",
+            "qty": int(qty or 0),
+            "omzet": omzet,
+            "hpp_cost": int(hpp_cost or 0),
+            "laba": laba,
+            "margin": round(laba * 100.0 / omzet, 1) if omzet else 0.0,
         })
+    return hasil
+
+def compute_laporan_periodik(start_str: str, end_str: str, status: str, top_n: int = 7):
+    """
+    Ringkasan laporan periodik dalam SATU round trip SQL (UNION ALL atas rollup penjualan_harian):
+    - seri harian → ringkasan (omzet, HPP, laba, dibayar/sisa, item)
+    - top-N produk (qty)
+    Laba = total - Σ(qty * hpp_satuan snapshot saat checkout).
+    Drill-down transaksi diambil terpisah & berhalaman lewat laporan_periodik_drill().
+    """
+    PH = PenjualanHarian
+    q_daily = _rollup_filter(
+        db.session.query(literal('D').label('jenis'), PH.tanggal.label('tanggal'),
+                         literal_column('NULL').label('produk_id'), literal_column('NULL').label('nama'),
+                         *_rollup_sums())
+        .filter(PH.produk_id == ROLLUP_TRX), start_str, end_str, status).group_by(PH.tanggal)
+
+    top_sq = _top_produk_subquery(start_str, end_str, status, top_n)
+    q_top = (db.session.query(
+                literal('P'), literal_column('NULL'), top_sq.c.produk_id, Produk.nama,
+                *[top_sq.c[c] for c in ROLLUP_COLS])
+             .outerjoin(Produk, Produk.id == top_sq.c.produk_id))
+
+    per_hari = {}
+    top_produk = []
+    for jenis, tgl, pid, nama, *vals in q_daily.union_all(q_top).all():
+        if jenis == 'D':
+            per_hari[tgl] = _daily_row(*vals)
+        else:
+            row = _daily_row(*vals)
+            top_produk.append({"produk_id": pid, "nama": nama or f"Produk #{pid}",
+                               "qty": row["qty"], "omzet": row["omzet"], "laba": row["laba"]})
+    top_produk.sort(key=lambda x: x["qty"], reverse=True)
 
-    total_laba = total_penjualan - total_hpp_cost
+    series = _fill_daily_series(per_hari, start_str, end_str)
+    tot = sum_daily_series(series)
 
+    total_trx = tot["trx"]
+    total_penjualan = tot["omzet"]
     return {
         "total_trx": total_trx,
         "total_penjualan": total_penjualan,
-        "total_hpp_cost": total_hpp_cost,
-        "total_laba": total_laba,
-        "total_dibayar": total_dibayar,
-        "total_sisa": total_sisa,
+        "total_hpp_cost": tot["hpp_cost"],
+        "total_laba": total_penjualan - tot["hpp_cost"],
+        "total_dibayar": tot["dibayar"],
+        "total_sisa": tot["sisa"],
         "avg_ticket": (total_penjualan / total_trx) if total_trx > 0 else 0,
-        "total_item_terjual": total_item_terjual,
-        "drill_rows": drill_rows,
+        "total_item_terjual": tot["qty"],
+        "series": series,
+        "top_produk": top_produk,
     }
 
+LAPORAN_DRILL_PAGE = 50
+
+def laporan_periodik_drill(start_str: str, end_str: str, status: str, before=None, limit: int = LAPORAN_DRILL_PAGE):
+    """
+    Satu halaman drill-down transaksi laporan periodik (keyset: id desc, id < before).
+    Return: (rows, next_before) — next_before None jika tidak ada halaman berikutnya.
+    """
+    cost_sq = _trx_cost_subquery()
+    q = (db.session.query(
+            Transaksi.id, Transaksi.tanggal, Transaksi.total, Transaksi.bayar,
+            Customer.nama, func.coalesce(cost_sq.c.hpp_cost, 0))
+         .outerjoin(cost_sq, cost_sq.c.transaksi_id == Transaksi.id)
+         .outerjoin(Customer, Customer.id == Transaksi.customer_id)
+         .filter(Transaksi.tanggal >= start_str,
+                 Transaksi.tanggal <= end_str))
+    q = _status_filter(q, status)
+    if before is not None:
+        q = q.filter(Transaksi.id < before)
+    res = q.order_by(Transaksi.id.desc()).limit(limit + 1).all()
+
+    drill_rows = []
+    for trx_id, tanggal, total, bayar, cust_nama, hpp_cost in res[:limit]:
+        total = total or 0
+        bayar = bayar or 0
+        sisa = max(0, total - bayar)
+        drill_rows.append({
+            "id": trx_id,
+            "tanggal": tanggal,
+            "customer": cust_nama or "-",
+            "total": total,
+            "hpp_cost": int(hpp_cost or 0),
+            "laba": total - int(hpp_cost or 0),
+            "bayar": bayar,
+            "sisa": sisa,
+            "status": "HUTANG" if sisa > 0 else "LUNAS"
+        })
+    next_before = drill_rows[-1]["id"] if len(res) > limit else None
+    return drill_rows, next_before
+
 def _trx_cost_and_profit(trxs):
-    """Hitung total HPP (Σ qty*hpp) dan Laba (Σ total - Σ hpp) untuk kumpulan transaksi."""
+    """Hitung total HPP (Σ qty*hpp_satuan) dan Laba (Σ total - Σ hpp) untuk kumpulan transaksi."""
     total_hpp = 0
     total_laba = 0
     for t in trxs:
         cost = 0
         for it in t.item_transaksi:
-            p = it.produk
-            hpp = int(p.hpp or 0) if p else 0
+            hpp = int(it.hpp_satuan or 0)
             qty = int(it.jumlah or 0)
             cost += (hpp * qty)
         total_hpp += cost
         total_laba += (int(t.total or 0) - cost)
     return total_hpp, total_laba
 
+def _laporan_overview_data(today: date):
+    """Angka overview laporan (kartu, seri 7 hari, top produk) — hanya data murni agar bisa di-cache."""
+    today_s = today.strftime("%Y-%m-%d")
+    last7_start = today - timedelta(days=6)
+    last7_start_s = last7_start.strftime("%Y-%m-%d")
+    month_start = today.replace(day=1)
+    month_start_s = month_start.strftime("%Y-%m-%d")
+    last30_start = today - timedelta(days=29)
+    last30_start_s = last30_start.strftime("%Y-%m-%d")
+
+    # Satu agregasi harian meliputi bulan berjalan + 7 hari terakhir
+    agg_start_s = min(last7_start, month_start).strftime("%Y-%m-%d")
+    series_all = daily_sales_aggregate(agg_start_s, today_s)
+    rows_last7 = [r for r in series_all if r["tanggal"] >= last7_start_s]
+    rows_month = [r for r in series_all if r["tanggal"] >= month_start_s]
+    row_today  = series_all[-1]
+
+    omzet_today = row_today["omzet"]
+    trx_today   = row_today["trx"]
+    laba_today  = row_today["laba"]
+
+    sum_last7 = sum_daily_series(rows_last7)
+    omzet_last7, laba_last7 = sum_last7["omzet"], sum_last7["laba"]
+
+    sum_month = sum_daily_series(rows_month)
+    omzet_month, laba_month = sum_month["omzet"], sum_month["laba"]
+
+    # Hutang Outstanding: Σ saldo piutang customer (O(customer)) + jumlah nota via index status
+    total_hutang_outstanding = int(db.session.query(func.coalesce(func.sum(Customer.saldo_piutang), 0)).scalar() or 0)
+    count_hutang_outstanding = (db.session.query(func.count(Transaksi.id))
+                                .filter(Transaksi.status == 'HUTANG').scalar() or 0)
+
+    # Series 7 hari (Omzet & Laba per hari)
+    series_labels = [r["label"] for r in rows_last7]
+    series_omzet  = [r["omzet"] for r in rows_last7]
+    series_laba   = [r["laba"] for r in rows_last7]
+
+    # Top produk 30 hari (qty) → siapkan juga array untuk chart
+    top_produk_30 = top_produk(last30_start_s, today_s, by='qty', n=5)
+    top30_names = [x["nama"] for x in top_produk_30]
+    top30_qtys  = [x["qty"]  for x in top_produk_30]
+
+    # Distribusi dibayar vs sisa (hari ini)
+    paid_today  = row_today["dibayar"]
+    sisa_today  = row_today["sisa"]
+
+    return {
+        "omzet_today": omzet_today,
+        "trx_today": trx_today,
+        "laba_today": laba_today,
+
+        "omzet_last7": omzet_last7,
+        "laba_last7": laba_last7,
+
+        "omzet_month": omzet_month,
+        "laba_month": laba_month,
+
+        "total_hutang_outstanding": total_hutang_outstanding,
+        "count_hutang_outstanding": count_hutang_outstanding,
+
+        "series_labels": series_labels,
+        "series_omzet": series_omzet,
+        "series_laba": series_laba,
+
+        "top_produk_30": top_produk_30,  # untuk tabel
+        "top30_names": top30_names,      # untuk chart
+        "top30_qtys": top30_qtys,        # untuk chart
+
+        "paid_today": paid_today,
+        "sisa_today": sisa_today,
+    }
+
+def _laporan_periodik_data(start_str: str, end_str: str, status: str):
+    """Data tab periodik laporan_home (ringkasan, grafik, top produk) — data murni agar bisa di-cache.
+    Drill-down tidak termasuk (berhalaman, diambil per request)."""
+    data = compute_laporan_periodik(start_str, end_str, status)
+
+    # Data untuk grafik periodik (Omzet & Laba per hari)
+    period_labels = [r["label"] for r in data["series"]]
+    period_omzet  = [r["omzet"] for r in data["series"]]
+    period_laba   = [r["laba"] for r in data["series"]]
+
+    # Distribusi dibayar vs sisa (periode)
+    paid_sum = data["total_dibayar"]
+    sisa_sum = data["total_sisa"]
+
+    # Top produk periode (qty) — sudah dihitung di round trip yang sama
+    top_sorted_p = data["top_produk"]
+    top_names_p = [x["nama"] for x in top_sorted_p]
+    top_qtys_p  = [x["qty"] for x in top_sorted_p]
+
+    # Margin per kategori
+    kategori_margin = margin_per_kategori(start_str, end_str, status)
+
+    return {
+        **data,
+
+        "period_labels": period_labels,
+        "period_omzet": period_omzet,
+        "period_laba": period_laba,
+
+        "paid_sum": paid_sum,
+        "sisa_sum": sisa_sum,
+
+        "top_names_p": top_names_p,
+        "top_qtys_p": top_qtys_p,
+
+        "kategori_margin": kategori_margin,
+    }
+
 @app.route('/laporan', endpoint='laporan_home')
 def laporan_home():
     view = request.args.get('view', 'overview')
@@ -976,34 +2610,10 @@ def laporan_home():
 
     # ====== OVERVIEW ======
     if view == 'overview':
-        qs_today = (Transaksi.query
-                    .filter(Transaksi.tanggal == today_s)
-                    .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                    .order_by(Transaksi.id.desc()).all())
-        omzet_today = sum((t.total or 0) for t in qs_today)
-        trx_today   = len(qs_today)
-        total_hpp_today, laba_today = _trx_cost_and_profit(qs_today)
-
-        qs_last7 = (Transaksi.query
-                    .filter(Transaksi.tanggal >= last7_start_s,
-                            Transaksi.tanggal <= today_s)
-                    .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                    .all())
-        omzet_last7 = sum((t.total or 0) for t in qs_last7)
-        total_hpp_last7, laba_last7 = _trx_cost_and_profit(qs_last7)
-
-        qs_month = (Transaksi.query
-                    .filter(Transaksi.tanggal >= month_start_s,
-                            Transaksi.tanggal <= today_s)
-                    .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                    .all())
-        omzet_month = sum((t.total or 0) for t in qs_month)
-        total_hpp_month, laba_month = _trx_cost_and_profit(qs_month)
-
-        # Hutang Outstanding + daftar hutang terbaru (untuk tabel)
-        qs_hutang = Transaksi.query.filter(Transaksi.status == 'HUTANG').order_by(Transaksi.id.desc()).all()
-        total_hutang_outstanding = sum(max(0, (t.sisa or ((t.total or 0)-(t.bayar or 0)))) for t in qs_hutang)
-        count_hutang_outstanding = len(qs_hutang)
+        ctx.update(cached_report('overview', today_s, today_s, 'all',
+                                 lambda: _laporan_overview_data(today)))
+
+        # Tabel berisi objek ORM → selalu diambil langsung (query kecil)
         hutang_terbaru = (Transaksi.query
                           .filter(Transaksi.status == 'HUTANG')
                           .order_by(Transaksi.id.desc())
@@ -1011,44 +2621,6 @@ def laporan_home():
                           .options(joinedload(Transaksi.customer))
                           .all())
 
-        # Series 7 hari (Omzet & Laba per hari)
-        series_labels = []
-        series_omzet = []
-        series_laba  = []
-        day_cursor = last7_start
-        for _ in range(7):
-            d_s = day_cursor.strftime("%Y-%m-%d")
-            rows = (Transaksi.query
-                    .filter(Transaksi.tanggal == d_s)
-                    .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                    .all())
-            s_omzet = sum((t.total or 0) for t in rows)
-            _, s_laba = _trx_cost_and_profit(rows)
-
-            series_labels.append(day_cursor.strftime("%d/%m"))
-            series_omzet.append(int(s_omzet))
-            series_laba.append(int(s_laba))
-            day_cursor += timedelta(days=1)
-
-        # Top produk 30 hari (qty) → siapkan juga array untuk chart
-        top_map = {}
-        trs_30 = (Transaksi.query.filter(Transaksi.tanggal >= last30_start_s,
-                                         Transaksi.tanggal <= today_s)
-                  .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                  .all())
-        for t in trs_30:
-            for it in t.item_transaksi:
-                p = it.produk
-                if not p: 
-                    continue
-                pid = p.id
-                if pid not in top_map:
-                    top_map[pid] = {"nama": p.nama, "qty": 0}
-                top_map[pid]["qty"] += (it.jumlah or 0)
-        top_produk_30 = sorted(top_map.values(), key=lambda x: x["qty"], reverse=True)[:5]
-        top30_names = [x["nama"] for x in top_produk_30]
-        top30_qtys  = [x["qty"]  for x in top_produk_30]
-
         # Transaksi hari ini (tabel)
         trx_today_rows = (Transaksi.query
                           .filter(Transaksi.tanggal == today_s)
@@ -1056,41 +2628,13 @@ def laporan_home():
                           .options(joinedload(Transaksi.customer))
                           .all())
 
-        # Distribusi dibayar vs sisa (hari ini)
-        paid_today  = sum((t.bayar or 0) for t in qs_today)
-        sisa_today  = sum(max(0, (t.total or 0) - (t.bayar or 0)) for t in qs_today)
-
         ctx.update({
             "today": today,
             "last7_start": last7_start,
             "month_start": month_start,
 
-            "omzet_today": omzet_today,
-            "trx_today": trx_today,
-            "laba_today": laba_today,
-
-            "omzet_last7": omzet_last7,
-            "laba_last7": laba_last7,
-
-            "omzet_month": omzet_month,
-            "laba_month": laba_month,
-
-            "total_hutang_outstanding": total_hutang_outstanding,
-            "count_hutang_outstanding": count_hutang_outstanding,
-
-            "series_labels": series_labels,
-            "series_omzet": series_omzet,
-            "series_laba": series_laba,
-
-            "top_produk_30": top_produk_30,  # untuk tabel
-            "top30_names": top30_names,      # untuk chart
-            "top30_qtys": top30_qtys,        # untuk chart
-
             "trx_today_rows": trx_today_rows,
             "hutang_terbaru": hutang_terbaru,
-
-            "paid_today": paid_today,
-            "sisa_today": sisa_today,
         })
         return render_template('laporan_home.html', **ctx)
 
@@ -1103,89 +2647,21 @@ def laporan_home():
         end_str   = request.args.get('end', default_end)
         status    = request.args.get('status', 'all')  # all|lunas|hutang
 
-        data = compute_laporan_periodik(start_str, end_str, status)
-
-        # Data untuk grafik periodik (Omzet & Laba per hari)
-        period_labels = []
-        period_omzet  = []
-        period_laba   = []
-        dt_start = datetime.strptime(start_str, "%Y-%m-%d").date()
-        dt_end   = datetime.strptime(end_str, "%Y-%m-%d").date()
-        cur = dt_start
-        while cur <= dt_end:
-            d_s = cur.strftime("%Y-%m-%d")
-            rows = (Transaksi.query
-                    .filter(Transaksi.tanggal == d_s)
-                    .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                    .all())
-            # filter status
-            if status == 'hutang':
-                rows = [t for t in rows if max(0,(t.total or 0)-(t.bayar or 0)) > 0]
-            elif status == 'lunas':
-                rows = [t for t in rows if max(0,(t.total or 0)-(t.bayar or 0)) == 0]
-
-            s_omzet = sum((t.total or 0) for t in rows)
-            _, s_laba = _trx_cost_and_profit(rows)
-
-            period_labels.append(cur.strftime("%d/%m"))
-            period_omzet.append(int(s_omzet))
-            period_laba.append(int(s_laba))
-            cur += timedelta(days=1)
-
-        # Distribusi dibayar vs sisa (periode)
-        qs_period = (Transaksi.query
-                     .filter(Transaksi.tanggal >= start_str,
-                             Transaksi.tanggal <= end_str)
-                     .all())
-        if status == 'hutang':
-            qs_period = [t for t in qs_period if max(0,(t.total or 0)-(t.bayar or 0)) > 0]
-        elif status == 'lunas':
-            qs_period = [t for t in qs_period if max(0,(t.total or 0)-(t.bayar or 0)) == 0]
-
-        paid_sum = sum((t.bayar or 0) for t in qs_period)
-        sisa_sum = sum(max(0, (t.total or 0) - (t.bayar or 0)) for t in qs_period)
-
-        # Top produk periode (qty)
-        top_map_p = {}
-        trs_period = (Transaksi.query
-                      .filter(Transaksi.tanggal >= start_str,
-                              Transaksi.tanggal <= end_str)
-                      .options(joinedload(Transaksi.item_transaksi).joinedload(ItemTransaksi.produk))
-                      .all())
-        if status == 'hutang':
-            trs_period = [t for t in trs_period if max(0,(t.total or 0)-(t.bayar or 0)) > 0]
-        elif status == 'lunas':
-            trs_period = [t for t in trs_period if max(0,(t.total or 0)-(t.bayar or 0)) == 0]
-
-        for t in trs_period:
-            for it in t.item_transaksi:
-                p = it.produk
-                if not p:
-                    continue
-                pid = p.id
-                if pid not in top_map_p:
-                    top_map_p[pid] = {"nama": p.nama, "qty": 0}
-                top_map_p[pid]["qty"] += (it.jumlah or 0)
-        top_sorted_p = sorted(top_map_p.values(), key=lambda x: x["qty"], reverse=True)[:7]
-        top_names_p = [x["nama"] for x in top_sorted_p]
-        top_qtys_p  = [x["qty"] for x in top_sorted_p]
+        ctx.update(cached_report('periodik', start_str, end_str, status,
+                                 lambda: _laporan_periodik_data(start_str, end_str, status)))
 
+        before = request.args.get('before', type=int)
+        drill_rows, next_before = laporan_periodik_drill(start_str, end_str, status, before=before)
         ctx.update({
             "current_view": "periodik",
             "start": start_str,
             "end": end_str,
             "status": status,
-            **data,
-
-            "period_labels": period_labels,
-            "period_omzet": period_omzet,
-            "period_laba": period_laba,
-
-            "paid_sum": paid_sum,
-            "sisa_sum": sisa_sum,
-
-            "top_names_p": top_names_p,
-            "top_qtys_p": top_qtys_p,
+            "drill_rows": drill_rows,
+            "drill_next_url": (url_for('laporan_home', view='periodik', start=start_str, end=end_str,
+                                       status=status, before=next_before) if next_before else None),
+            "drill_first_url": (url_for('laporan_home', view='periodik', start=start_str, end=end_str,
+                                        status=status) if before else None),
         })
         return render_template('laporan_home.html', **ctx)
 
@@ -1314,6 +2790,42 @@ def laporan_home():
     })
     return render_template('laporan_home.html', **ctx)
 
+@app.route('/laporan/top_produk', endpoint='laporan_top_produk')
+def laporan_top_produk():
+    """
+    JSON analitik produk untuk grafik/ad-hoc.
+    Query: start, end (default 30 hari terakhir), by=qty|omzet|laba, n, status, kategori=1
+    """
+    today = date.today()
+    start_str = (request.args.get('start') or (today - timedelta(days=29)).strftime("%Y-%m-%d")).strip()
+    end_str   = (request.args.get('end') or today.strftime("%Y-%m-%d")).strip()
+    by        = (request.args.get('by') or 'qty').strip()
+    status    = (request.args.get('status') or 'all').strip()
+    n         = max(1, min(100, request.args.get('n', default=10, type=int)))
+
+    def build():
+        data = {"produk": top_produk(start_str, end_str, by=by, n=n, status=status)}
+        if request.args.get('kategori') == '1':
+            data["kategori"] = margin_per_kategori(start_str, end_str, status)
+        return data
+
+    key_view = f"top_produk:{by}:{n}:{request.args.get('kategori') == '1'}"
+    return jsonify({"start": start_str, "end": end_str, "by": by,
+                    **cached_report(key_view, start_str, end_str, status, build)})
+
+@app.route('/laporan/cache', endpoint='laporan_cache_stats')
+def laporan_cache_stats():
+    """Statistik cache laporan (hit/miss) untuk memantau efektivitas cache."""
+    hit = _report_cache_stats["hit"]
+    miss = _report_cache_stats["miss"]
+    return jsonify({
+        "hit": hit,
+        "miss": miss,
+        "hit_ratio": round(hit / (hit + miss), 3) if (hit + miss) else 0,
+        "entries": len(_report_cache),
+        "generation": current_report_generation(),
+    })
+
 @app.route('/laporan/periodik')
 def laporan_periodik_redirect():
     return redirect(url_for('laporan_home', view='periodik'))
@@ -1331,19 +2843,96 @@ def laporan_periodik():
 
     data = compute_laporan_periodik(start_str, end_str, status)
 
+    before = request.args.get('before', type=int)
+    drill_rows, next_before = laporan_periodik_drill(start_str, end_str, status, before=before)
+
     return render_template(
         'laporan_periodik.html',
         start=start_str,
         end=end_str,
         status=status,
+        drill_rows=drill_rows,
+        drill_next_url=(url_for('laporan_periodik', start=start_str, end=end_str,
+                                status=status, before=next_before) if next_before else None),
+        drill_first_url=(url_for('laporan_periodik', start=start_str, end=end_str,
+                                 status=status) if before else None),
         **data
     )
 
 # ==================== TRANSAKSI LIST/DETAIL ====================
+TRANSAKSI_PAGE_SIZE = 50
+
 @app.route('/transaksi')
 def transaksi_list():
-    daftar_transaksi = Transaksi.query.order_by(Transaksi.id.desc()).all()
-    return render_template('transaksi_list.html', daftar_transaksi=daftar_transaksi)
+    """
+    Riwayat transaksi dengan keyset pagination (urut id desc) + filter server-side.
+    Query string: start, end, status (LUNAS/HUTANG), customer_id, min_total, max_total,
+    before=<id> → halaman lebih lama, after=<id> → halaman lebih baru.
+    """
+    f_start  = (request.args.get('start') or '').strip()
+    f_end    = (request.args.get('end') or '').strip()
+    f_status = (request.args.get('status') or '').strip().upper()
+    f_cust   = (request.args.get('customer_id') or '').strip()
+    f_min    = (request.args.get('min_total') or '').strip()
+    f_max    = (request.args.get('max_total') or '').strip()
+    before   = request.args.get('before', type=int)
+    after    = request.args.get('after', type=int)
+
+    item_count = (db.session.query(func.count(ItemTransaksi.id))
+                  .filter(ItemTransaksi.transaksi_id == Transaksi.id)
+                  .correlate(Transaksi)
+                  .scalar_subquery())
+    q = (db.session.query(
+            Transaksi.id, Transaksi.tanggal, Transaksi.total, Transaksi.status, Transaksi.sisa,
+            Customer.nama.label('customer'), item_count.label('item_count'))
+         .outerjoin(Customer, Customer.id == Transaksi.customer_id))
+
+    if f_start:
+        q = q.filter(Transaksi.tanggal >= f_start)
+    if f_end:
+        q = q.filter(Transaksi.tanggal <= f_end)
+    if f_status in ('LUNAS', 'HUTANG'):
+        q = q.filter(Transaksi.status == f_status)
+    if f_cust.isdigit():
+        q = q.filter(Transaksi.customer_id == int(f_cust))
+    if f_min:
+        q = q.filter(Transaksi.total >= to_int_safely(f_min))
+    if f_max:
+        q = q.filter(Transaksi.total <= to_int_safely(f_max))
+
+    n = TRANSAKSI_PAGE_SIZE
+    if after is not None:
+        rows = q.filter(Transaksi.id > after).order_by(Transaksi.id.asc()).limit(n + 1).all()
+        has_newer = len(rows) > n
+        rows = list(reversed(rows[:n]))
+        has_older = True
+    else:
+        if before is not None:
+            q = q.filter(Transaksi.id < before)
+        rows = q.order_by(Transaksi.id.desc()).limit(n + 1).all()
+        has_older = len(rows) > n
+        rows = rows[:n]
+        has_newer = before is not None
+
+    filters = {k: v for k, v in {
+        "start": f_start, "end": f_end, "status": f_status, "customer_id": f_cust,
+        "min_total": f_min, "max_total": f_max,
+    }.items() if v}
+    older_url = url_for('transaksi_list', before=rows[-1].id, **filters) if (rows and has_older) else None
+    newer_url = url_for('transaksi_list', after=rows[0].id, **filters) if (rows and has_newer) else None
+
+    # Filter customer: hanya nama customer terpilih; pencarian lewat /api/customer/cari.
+    # Customer sudah dihapus → filter customer_id tetap dipakai, label pakai id.
+    customer_nama = None
+    if f_cust.isdigit():
+        customer_nama = (db.session.query(Customer.nama).filter(Customer.id == int(f_cust)).scalar()
+                         or f"Customer #{f_cust} (dihapus)")
+    return render_template('transaksi_list.html',
+                           daftar_transaksi=rows,
+                           customer_nama=customer_nama,
+                           filters=filters,
+                           older_url=older_url,
+                           newer_url=newer_url)
 
 @app.route('/transaksi/<int:id>')
 def transaksi_detail(id):
@@ -1357,6 +2946,39 @@ def transaksi_detail(id):
     prev_url = request.args.get('prev') or request.referrer or url_for('transaksi_list')
     return render_template('transaksi_detail.html', transaksi=transaksi, prev_url=prev_url)
 
+# ==================== PIUTANG ====================
+@app.route('/piutang', endpoint='piutang_list')
+def piutang_list():
+    """Ringkasan piutang: saldo per customer + aging (umur piutang) dari SQL."""
+    aging = aging_piutang()
+    total_bucket = {k: sum(r[k] for r in aging) for k in AGING_BUCKETS}
+    total_saldo = int(db.session.query(func.coalesce(func.sum(Customer.saldo_piutang), 0)).scalar() or 0)
+    pembayaran_terbaru = (PembayaranPiutang.query
+                          .options(joinedload(PembayaranPiutang.customer))
+                          .order_by(PembayaranPiutang.id.desc())
+                          .limit(10)
+                          .all())
+    return render_template('piutang.html',
+                           aging=aging,
+                           buckets=AGING_BUCKETS,
+                           total_bucket=total_bucket,
+                           total_saldo=total_saldo,
+                           pembayaran_terbaru=pembayaran_terbaru)
+
+@app.route('/piutang/bayar/<int:trx_id>', methods=['POST'], endpoint='piutang_bayar')
+def piutang_bayar(trx_id):
+    trx = Transaksi.query.get_or_404(trx_id)
+    tanggal = (request.form.get('tanggal') or '').strip() or date.today().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(tanggal, "%Y-%m-%d")
+    except ValueError:
+        flash("Format tanggal pembayaran tidak valid.", "error")
+        return redirect(url_for('transaksi_detail', id=trx.id))
+    ok, msg = bayar_piutang(trx, to_int_safely(request.form.get('jumlah')), tanggal,
+                            catatan=request.form.get('catatan'))
+    flash(msg, "success" if ok else "error")
+    return redirect(url_for('transaksi_detail', id=trx.id))
+
 # ==================== CRUD PRODUK ====================
 def to_float(val):
     try:
@@ -1366,8 +2988,36 @@ def to_float(val):
 
 @app.route('/produk')
 def produk_list():
-    daftar_produk = Produk.query.all()
-    return render_template('produk_list.html', daftar_produk=daftar_produk)
+    q = (request.args.get('q') or '').strip()
+    if q:
+        daftar_produk = cari_produk(q, limit=200)
+    else:
+        daftar_produk = Produk.query.all()
+    return render_template('produk_list.html', daftar_produk=daftar_produk, q=q)
+
+@app.route('/api/produk/cari', endpoint='api_produk_cari')
+def api_produk_cari():
+    """Pencarian produk (FTS5, prefix + ranking) → JSON ringkas untuk kasir."""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    hasil = cari_produk(request.args.get('q'), limit=limit)
+    return jsonify({"produk": [_produk_json(p) for p in hasil]})
+
+@app.route('/api/produk/scan', endpoint='api_produk_scan')
+def api_produk_scan():
+    """Scan barcode/SKU: exact match lewat index unik (1 lookup)."""
+    kode = (request.args.get('kode') or '').strip()
+    p = Produk.query.filter_by(barcode=kode).first() if kode else None
+    if not p:
+        return _api_error("Barcode tidak terdaftar.", 404)
+    data = _produk_json(p)
+    data["opsi_harga"] = [{"id": ph.id, "label": ph.label, "harga": ph.harga, "default": ph.is_default}
+                          for ph in p.harga_list]
+    return jsonify({"ok": True, "produk": data})
+
+def _produk_json(p):
+    return {"id": p.id, "nama": p.nama, "harga": p.harga, "stok": p.stok or 0,
+            "barcode": p.barcode, "foto": p.foto,
+            "kategori": p.kategori.nama if p.kategori else None}
 
 @app.route('/produk/tambah', methods=['GET', 'POST'])
 def produk_tambah():
@@ -1378,9 +3028,12 @@ def produk_tambah():
         stok  = request.form.get('stok') or '0'
         kategori_id = request.form.get('kategori_id')
         is_manufaktur = 1 if request.form.get('is_manufaktur') == '1' else 0
+        barcode = (request.form.get('barcode') or '').strip() or None
 
         if not nama or not harga_utama.isdigit() or not stok.isdigit() or not hpp.isdigit():
             return "Input tidak valid", 400
+        if barcode and Produk.query.filter_by(barcode=barcode).first():
+            return "Barcode/SKU sudah dipakai produk lain", 400
 
         foto_file = request.files.get('foto')
         foto_filename = None
@@ -1395,7 +3048,8 @@ def produk_tambah():
             stok=int(stok),
             foto=foto_filename,
             kategori_id=int(kategori_id) if kategori_id and kategori_id.isdigit() else None,
-            is_manufaktur=is_manufaktur
+            is_manufaktur=is_manufaktur,
+            barcode=barcode
         )
         db.session.add(p)
         db.session.flush()  # dapat p.id
@@ -1428,6 +3082,8 @@ def produk_tambah():
                     continue
                 db.session.add(ResepBahan(produk_id=p.id, bahan_id=bahan_id, qty=qty))
 
+        bump_catalog_generation()
+        bump_bom_generation()
         db.session.commit()
         return redirect(url_for('produk_list'))
 
@@ -1445,16 +3101,22 @@ def produk_edit(id):
         stok  = request.form.get('stok') or '0'
         kategori_id = request.form.get('kategori_id')
         is_manufaktur = 1 if request.form.get('is_manufaktur') == '1' else 0
+        barcode = (request.form.get('barcode') or '').strip() or None
 
         if not nama or not harga_utama.isdigit() or not stok.isdigit() or not hpp.isdigit():
             return "Input tidak valid", 400
+        if barcode and Produk.query.filter(Produk.barcode == barcode, Produk.id != produk.id).first():
+            return "Barcode/SKU sudah dipakai produk lain", 400
 
+        if int(hpp) != int(produk.hpp or 0) or nama != produk.nama:
+            bump_report_generation()
         produk.nama  = nama
         produk.harga = int(harga_utama)
         produk.hpp   = int(hpp)
         produk.stok  = int(stok)
         produk.kategori_id = int(kategori_id) if kategori_id and kategori_id.isdigit() else None
         produk.is_manufaktur = is_manufaktur
+        produk.barcode = barcode
 
         foto_file = request.files.get('foto')
         if foto_file and foto_file.filename:
@@ -1481,6 +3143,14 @@ def produk_edit(id):
                     continue
                 db.session.add(ResepBahan(produk_id=produk.id, bahan_id=bahan_id, qty=qty))
 
+            db.session.flush()
+            ok, msg = bom_cek_siklus(produk.id)
+            if not ok:
+                db.session.rollback()
+                return msg, 400
+
+        bump_catalog_generation()
+        bump_bom_generation()
         db.session.commit()
         return redirect(url_for('produk_list'))
 
@@ -1492,10 +3162,23 @@ def produk_edit(id):
 def produk_hapus(id):
     produk = Produk.query.get_or_404(id)
     db.session.delete(produk)
+    bump_report_generation()
+    bump_catalog_generation()
+    bump_bom_generation()
     db.session.commit()
     return redirect(url_for('produk_list'))
 
 # ==================== CRUD CUSTOMER ====================
+@app.route('/api/customer/cari', endpoint='api_customer_cari')
+def api_customer_cari():
+    """Pencarian customer (nama / no. telepon) → JSON ringkas untuk picker filter."""
+    limit = min(max(request.args.get('limit', 15, type=int), 1), 50)
+    q = Customer.query
+    for t in (request.args.get('q') or '').split():
+        q = q.filter(db.or_(Customer.nama.ilike(f'%{t}%'), Customer.no_telepon.ilike(f'%{t}%')))
+    rows = q.order_by(Customer.nama.asc()).limit(limit).all()
+    return jsonify({"customer": [{"id": c.id, "nama": c.nama, "no_telepon": c.no_telepon} for c in rows]})
+
 @app.route('/customer')
 def customer_list():
     customers = Customer.query.all()
@@ -1563,6 +3246,7 @@ def kategori_tambah():
 
         k = Kategori(nama=nama)
         db.session.add(k)
+        bump_catalog_generation()
         db.session.commit()
         return redirect(url_for('kategori_list'))
     return render_template('kategori_tambah.html')
@@ -1580,6 +3264,8 @@ def kategori_edit(id):
             return "Kategori dengan nama tersebut sudah ada", 400
 
         k.nama = nama
+        bump_catalog_generation()
+        bump_report_generation()
         db.session.commit()
         return redirect(url_for('kategori_list'))
     return render_template('kategori_edit.html', kategori=k)
@@ -1590,6 +3276,8 @@ def kategori_hapus(id):
     if k.produk and len(k.produk) > 0:
         return "Kategori tidak bisa dihapus karena masih dipakai produk.", 400
     db.session.delete(k)
+    bump_catalog_generation()
+    bump_report_generation()
     db.session.commit()
     return redirect(url_for('kategori_list'))
 
@@ -1642,38 +3330,155 @@ def stok_adjust():
     flash(msg, "success" if ok else "error")
     return redirect(url_for('stok_dashboard'))
 
+# ============== NILAI PERSEDIAAN (PER TANGGAL) ==============
+@app.route('/stok/nilai')
+def stok_nilai():
+    tanggal = (request.args.get('tanggal') or '').strip() or date.today().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(tanggal, "%Y-%m-%d")
+    except ValueError:
+        flash("Tanggal tidak valid.", "error")
+        return redirect(url_for('stok_nilai'))
+    kategori_id = request.args.get('kategori_id', type=int)
+
+    baris, per_produk = nilai_stok_per_kategori(tanggal)
+
+    detail = []
+    if request.args.get('kategori_id') is not None:
+        q = db.session.query(Produk.id, Produk.nama).filter(Produk.kategori_id == kategori_id) \
+            if kategori_id else db.session.query(Produk.id, Produk.nama).filter(Produk.kategori_id.is_(None))
+        detail = sorted(({"id": pid, "nama": nama, "stok": per_produk[pid][0], "hpp": per_produk[pid][1],
+                          "nilai": per_produk[pid][2]} for pid, nama in q if pid in per_produk),
+                        key=lambda r: -r["nilai"])
+
+    return render_template(
+        'stok_nilai.html', tanggal=tanggal, baris=baris, detail=detail,
+        kategori_id=request.args.get('kategori_id'),
+        total_nilai=sum(r["nilai"] for r in baris), total_qty=sum(r["qty"] for r in baris)
+    )
+
+@app.cli.command('snapshot-stok')
+@click.option('--tanggal', default=None, help='Tanggal checkpoint YYYY-MM-DD (default: periode terakhir).')
+def snapshot_stok_command(tanggal):
+    """Buat checkpoint stok & HPP (jalankan harian via cron)."""
+    tanggal = tanggal or tanggal_snapshot_terakhir()
+    try:
+        n = buat_snapshot_stok(tanggal)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # proses lain membuat checkpoint yang sama bersamaan
+        n = 0
+    click.echo(f"Checkpoint {tanggal}: {n} produk." if n else f"Checkpoint {tanggal} sudah ada.")
+
+# ============== RENCANA PRODUKSI (MRP) ==============
+def _parse_rencana(items):
+    """[(produk_id, qty), ...] → {produk_id: qty} (qty dijumlahkan, entri tidak valid diabaikan)."""
+    rencana = {}
+    for pid, q in items:
+        try:
+            pid, q = int(pid), int(q or 0)
+        except (TypeError, ValueError):
+            continue
+        if q > 0:
+            rencana[pid] = rencana.get(pid, 0) + q
+    return rencana
+
+@app.route('/stok/rencana')
+def produksi_rencana():
+    """Form rencana produksi: qty_<produk_id>=N; hanya membaca, aman diulang (GET)."""
+    rencana = _parse_rencana((k[4:], v) for k, v in request.args.items() if k.startswith('qty_'))
+    ok, msg, hasil = rencana_produksi(rencana)
+    if not ok:
+        flash(msg, "error")
+        hasil = {"produk": [], "kebutuhan": [], "cukup": True}
+    return render_template('produksi_rencana.html', hasil=hasil, ada_rencana=bool(rencana))
+
+@app.route('/api/produksi/rencana', methods=['POST'], endpoint='api_produksi_rencana')
+def api_produksi_rencana():
+    """JSON: {"rencana": [{"produk_id": 1, "qty": 10}, ...]} atau {"rencana": {"1": 10}}."""
+    data = request.get_json(silent=True) or {}
+    raw = data.get("rencana") or []
+    if isinstance(raw, dict):
+        items = raw.items()
+    elif isinstance(raw, list):
+        items = [(r.get("produk_id"), r.get("qty")) for r in raw if isinstance(r, dict)]
+    else:
+        return _api_error("Format rencana tidak valid.")
+    ok, msg, hasil = rencana_produksi(_parse_rencana(items))
+    if not ok:
+        return _api_error(msg)
+    return jsonify({"ok": True, **hasil})
+
 # ============== LAPORAN MUTASI STOK ==============
+STOK_MUTASI_PAGE_SIZE = 50
+
 @app.route('/stok/mutasi')
 def stok_mutasi_list():
+    """
+    Kartu stok dengan keyset pagination (urut id desc) + filter server-side.
+    Query string: start, end, produk_id, tipe (IN/OUT),
+    before=<id> → halaman lebih lama, after=<id> → halaman lebih baru.
+    Total IN/OUT dihitung 1 query agregat atas seluruh hasil filter (bukan hanya halaman ini).
+    """
     start = (request.args.get('start') or '').strip()
     end   = (request.args.get('end') or '').strip()
     pid   = (request.args.get('produk_id') or '').strip()
     tipe  = (request.args.get('tipe') or '').strip().upper()  # '', 'IN', 'OUT'
+    before = request.args.get('before', type=int)
+    after  = request.args.get('after', type=int)
 
-    q = StockMutasi.query.order_by(StockMutasi.id.desc())
-
+    conds = []
     if start:
-        q = q.filter(StockMutasi.tanggal >= start)
+        conds.append(StockMutasi.tanggal >= start)
     if end:
-        q = q.filter(StockMutasi.tanggal <= end)
+        conds.append(StockMutasi.tanggal <= end)
     if pid.isdigit():
-        q = q.filter(StockMutasi.produk_id == int(pid))
+        conds.append(StockMutasi.produk_id == int(pid))
     if tipe in ('IN', 'OUT'):
-        q = q.filter(StockMutasi.tipe == tipe)
-
-    rows = q.all()
-    produk_all = Produk.query.order_by(Produk.nama.asc()).all()
+        conds.append(StockMutasi.tipe == tipe)
+
+    total_in, total_out = (db.session.query(
+            func.coalesce(func.sum(case((StockMutasi.tipe == 'IN', StockMutasi.qty), else_=0)), 0),
+            func.coalesce(func.sum(case((StockMutasi.tipe == 'OUT', StockMutasi.qty), else_=0)), 0))
+        .filter(*conds).one())
+
+    q = StockMutasi.query.options(joinedload(StockMutasi.produk)).filter(*conds)
+    n = STOK_MUTASI_PAGE_SIZE
+    if after is not None:
+        rows = q.filter(StockMutasi.id > after).order_by(StockMutasi.id.asc()).limit(n + 1).all()
+        has_newer = len(rows) > n
+        rows = list(reversed(rows[:n]))
+        has_older = True
+    else:
+        if before is not None:
+            q = q.filter(StockMutasi.id < before)
+        rows = q.order_by(StockMutasi.id.desc()).limit(n + 1).all()
+        has_older = len(rows) > n
+        rows = rows[:n]
+        has_newer = before is not None
+
+    filters = {k: v for k, v in {
+        "start": start, "end": end, "produk_id": pid, "tipe": tipe,
+    }.items() if v}
+    older_url = url_for('stok_mutasi_list', before=rows[-1].id, **filters) if (rows and has_older) else None
+    newer_url = url_for('stok_mutasi_list', after=rows[0].id, **filters) if (rows and has_newer) else None
+
+    # Picker produk: hanya nama produk terpilih; pencarian lewat /api/produk/cari.
+    # Produk sudah dihapus → filter produk_id tetap dipakai, label pakai id.
+    produk_nama = None
+    if pid.isdigit():
+        produk_nama = (db.session.query(Produk.nama).filter(Produk.id == int(pid)).scalar()
+                       or f"Produk #{pid} (dihapus)")
     today = date.today().strftime("%Y-%m-%d")
 
-    total_in  = sum(r.qty for r in rows if r.tipe == 'IN')
-    total_out = sum(r.qty for r in rows if r.tipe == 'OUT')
-
     return render_template(
         'stok_mutasi.html',
-        rows=rows, produk_all=produk_all, today=today,
+        rows=rows, produk_nama=produk_nama, today=today,
         start=start, end=end, produk_id=pid, tipe=tipe,
-        total_in=total_in, total_out=total_out
+        total_in=int(total_in), total_out=int(total_out),
+        older_url=older_url, newer_url=newer_url
     )
+
 # ==================== KARYAWAN ====================
 
 # ============== MANAJEMEN KARYAWAN ==============
@@ -1794,6 +3599,95 @@ def pekerjaan_hapus(id):
     return redirect(url_for('pekerjaan_list'))
 
 # ============== PRODUKSI KARYAWAN (ENTRY HARIAN) ==============
+def buat_entry_produksi(k, pk, tanggal, qty, rate_override=None, catatan='', apply_to_stock=False):
+    """Tambah 1 ProduksiKaryawan ke sesi (tanpa commit); rate = override atau rate pekerjaan."""
+    rate_override = str(rate_override or '')
+    rate = int(rate_override) if rate_override.isdigit() else int(pk.rate_per_unit or 0)
+    pr = ProduksiKaryawan(
+        tanggal=tanggal,
+        karyawan_id=k.id,
+        pekerjaan_id=pk.id,
+        qty=qty,
+        rate_snapshot=rate,
+        total_upah=rate * qty,
+        catatan=catatan,
+        apply_to_stock=apply_to_stock
+    )
+    db.session.add(pr)
+    return pr
+
+def baris_produksi_entry(pr, k, pk):
+    """Baris produksi_batch() untuk entry karyawan (pr harus sudah punya id)."""
+    return {"produk_id": pk.produk_id, "qty": pr.qty,
+            "catatan": f"Produksi karyawan {k.nama}: {pk.nama}",
+            "referensi": f"PRODKAR-{pr.id}"}
+
+@app.route('/api/produksi/batch', methods=['POST'], endpoint='api_produksi_batch')
+def api_produksi_batch():
+    """
+    Posting produksi sehari sekaligus — 1 transaksi, 1 commit.
+    JSON: {"tanggal": "YYYY-MM-DD"?, "baris": [
+        {"produk_id": 1, "qty": 10, "catatan"?, "referensi"?},                  # produksi langsung
+        {"karyawan_id": 2, "pekerjaan_id": 3, "qty": 5,
+         "rate_override"?, "catatan"?, "apply_to_stock"?: true}                 # entry karyawan
+    ]}
+    Satu baris gagal → tidak ada yang tersimpan.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return _api_error("Body harus berupa objek JSON.")
+    tanggal = str(data.get("tanggal") or date.today().strftime("%Y-%m-%d"))[:10]
+    try:
+        datetime.strptime(tanggal, "%Y-%m-%d")
+    except ValueError:
+        return _api_error("tanggal tidak valid (YYYY-MM-DD).")
+    baris = data.get("baris")
+    if not isinstance(baris, list) or not baris:
+        return _api_error("baris wajib berupa list dan tidak kosong.")
+
+    k_ids  = {to_int_safely(b.get("karyawan_id")) for b in baris if isinstance(b, dict) and b.get("pekerjaan_id")}
+    pk_ids = {to_int_safely(b.get("pekerjaan_id")) for b in baris if isinstance(b, dict) and b.get("pekerjaan_id")}
+    karyawan  = {k.id: k for k in Karyawan.query.filter(Karyawan.id.in_(k_ids))} if k_ids else {}
+    pekerjaan = {p.id: p for p in Pekerjaan.query.filter(Pekerjaan.id.in_(pk_ids))} if pk_ids else {}
+
+    lines, entries = [], []
+    for i, b in enumerate(baris, start=1):
+        if not isinstance(b, dict):
+            return _api_error(f"Baris {i}: format tidak valid.")
+        qty = to_int_safely(b.get("qty"))
+        if qty <= 0:
+            return _api_error(f"Baris {i}: qty harus lebih dari 0.")
+        if b.get("pekerjaan_id"):
+            k  = karyawan.get(to_int_safely(b.get("karyawan_id")))
+            pk = pekerjaan.get(to_int_safely(b.get("pekerjaan_id")))
+            if not k or not pk:
+                return _api_error(f"Baris {i}: karyawan atau pekerjaan tidak ditemukan.")
+            apply_to_stock = b.get("apply_to_stock", True)
+            if not isinstance(apply_to_stock, bool):
+                return _api_error(f"Baris {i}: apply_to_stock harus true/false.")
+            apply_to_stock = apply_to_stock and bool(pk.produk_id)
+            pr = buat_entry_produksi(k, pk, tanggal, qty, b.get("rate_override"),
+                                     str(b.get("catatan") or "").strip(), apply_to_stock)
+            entries.append((pr, k, pk))
+            if apply_to_stock:
+                lines.append((pr, k, pk))  # jadi baris produksi setelah flush (butuh id)
+        else:
+            lines.append({"produk_id": b.get("produk_id"), "qty": qty,
+                          "catatan": b.get("catatan"), "referensi": b.get("referensi")})
+
+    msg = f"{len(entries)} entry karyawan tersimpan."
+    if entries:
+        db.session.flush()  # id entry → referensi PRODKAR-<id>
+        lines = [baris_produksi_entry(*ln) if isinstance(ln, tuple) else ln for ln in lines]
+    if lines:
+        ok, msg = produksi_batch(lines, tanggal, commit=False)
+        if not ok:
+            db.session.rollback()
+            return _api_error(msg)
+
+    db.session.commit()
+    return jsonify({"ok": True, "msg": msg, "entry_ids": [pr.id for pr, _, _ in entries]})
+
 def week_range(d: date):
     """Kembalikan (senin, sabtu) untuk minggu dari tanggal d."""
     monday = d - timedelta(days=d.weekday())          # 0=Senin
@@ -1822,34 +3716,17 @@ def produksi_karyawan():
             flash("Karyawan atau pekerjaan tidak ditemukan.", "error")
             return redirect(url_for('produksi_karyawan'))
 
-        # rate snapshot
-        rate = int(rate_override) if (rate_override and rate_override.isdigit()) else int(pk.rate_per_unit or 0)
-        total = rate * qty
-
-        pr = ProduksiKaryawan(
-            tanggal=tanggal,
-            karyawan_id=k.id,
-            pekerjaan_id=pk.id,
-            qty=qty,
-            rate_snapshot=rate,
-            total_upah=total,
-            catatan=catatan,
-            apply_to_stock=apply_to_stock
-        )
-        db.session.add(pr)
+        pr = buat_entry_produksi(k, pk, tanggal, qty, rate_override, catatan, apply_to_stock)
         db.session.flush()  # dapat id
 
-        # Jika perlu update stok (pekerjaan terkait produk manufaktur)
+        # Jika perlu update stok (pekerjaan terkait produk manufaktur) → entry & stok 1 commit
         if apply_to_stock and pk.produk_id:
-            # panggil produksi manufaktur
-            ok, msg = produce_manufactured_product(
-                produk_id=pk.produk_id,
-                qty=qty,
-                tanggal=tanggal,
-                catatan=f"Produksi karyawan {k.nama}: {pk.nama}",
-                referensi=f"PRODKAR-{pr.id}"
-            )
-            flash(("STOK: " + msg), "success" if ok else "error")
+            ok, msg = produksi_batch([baris_produksi_entry(pr, k, pk)], tanggal, commit=False)
+            if not ok:
+                db.session.rollback()
+                flash("STOK: " + msg + " Entry tidak disimpan.", "error")
+                return redirect(url_for('produksi_karyawan'))
+            flash("STOK: " + msg, "success")
 
         db.session.commit()
         flash("Entry produksi tersimpan.", "success")
@@ -1953,6 +3830,7 @@ def room_new():
     r = Room(kode=kode, status='open')
     db.session.add(r)
     db.session.commit()
+    purge_closed_rooms_periodik()
     session['room_code'] = r.kode
     return redirect(url_for('index'))
 
@@ -1962,28 +3840,136 @@ def room_switch(kode):
     session['room_code'] = r.kode
     return redirect(url_for('index'))
 
+ROOMS_CLOSED_PAGE = 30
+# Room closed (beserta item) lebih tua dari N hari dihapus oleh purge_closed_rooms / `flask purge-rooms`.
+ROOM_RETENTION_DAYS = int(os.environ.get('POS_ROOM_RETENTION_DAYS') or 30)
+ROOM_PURGE_BATCH = 500
+ROOM_PURGE_INTERVAL = 3600   # detik; purge otomatis paling sering sekali per jam per proses
+_room_purge_last = {"ts": 0.0}
+
+def purge_closed_rooms(days=None, batch=ROOM_PURGE_BATCH, max_batches=None):
+    """
+    Hapus room berstatus closed yang ditutup (atau dibuat, untuk data lama) lebih dari `days` hari,
+    beserta RoomItem-nya. Diproses per batch id (commit tiap batch) agar lock tulis SQLite singkat.
+    Return: jumlah room yang dihapus.
+    """
+    days = ROOM_RETENTION_DAYS if days is None else int(days)
+    # created_at/closed_at = CURRENT_TIMESTAMP (UTC naif) → bandingkan dengan UTC tanpa tzinfo
+    batas = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+    total, putaran = 0, 0
+    while max_batches is None or putaran < max_batches:
+        ids = [rid for (rid,) in db.session.query(Room.id)
+               .filter(Room.status == 'closed',
+                       func.coalesce(Room.closed_at, Room.created_at) < batas)
+               .order_by(Room.id.asc())
+               .limit(batch)]
+        if not ids:
+            break
+        db.session.execute(delete(RoomItem).where(RoomItem.room_id.in_(ids)))
+        db.session.execute(delete(Room).where(Room.id.in_(ids)))
+        db.session.commit()
+        total += len(ids)
+        putaran += 1
+        if len(ids) < batch:
+            break
+    return total
+
+def purge_closed_rooms_periodik():
+    """Purge satu batch bila interval sudah lewat (dipanggil saat room baru dibuat)."""
+    now = datetime.now(timezone.utc).timestamp()
+    if now - _room_purge_last["ts"] < ROOM_PURGE_INTERVAL:
+        return
+    _room_purge_last["ts"] = now
+    try:
+        purge_closed_rooms(max_batches=1)
+    except Exception as e:
+        db.session.rollback()
+        print("INFO purge room:", e)
+
+@app.cli.command('purge-rooms')
+@click.option('--days', type=int, default=None, help='Umur minimal room closed (hari).')
+@click.option('--batch', type=int, default=ROOM_PURGE_BATCH, help='Jumlah room per batch.')
+def purge_rooms_command(days, batch):
+    """Hapus room closed lama beserta itemnya."""
+    n = purge_closed_rooms(days=days, batch=batch)
+    click.echo(f"{n} room closed dihapus.")
+
 @app.route('/rooms')
 def rooms_list():
-    rooms_open   = Room.query.filter_by(status='open').order_by(Room.created_at.desc()).all()
-    rooms_closed = Room.query.filter_by(status='closed').order_by(Room.created_at.desc()).all()
+    rooms_open = Room.query.filter_by(status='open').order_by(Room.id.desc()).all()
+
+    # Room closed: keyset pagination id desc (?before=<id>)
+    before = request.args.get('before', type=int)
+    q_closed = Room.query.filter_by(status='closed')
+    if before:
+        q_closed = q_closed.filter(Room.id < before)
+    rooms_closed = q_closed.order_by(Room.id.desc()).limit(ROOMS_CLOSED_PAGE + 1).all()
+    closed_next_url = None
+    if len(rooms_closed) > ROOMS_CLOSED_PAGE:
+        rooms_closed = rooms_closed[:ROOMS_CLOSED_PAGE]
+        closed_next_url = url_for('rooms_list', before=rooms_closed[-1].id)
+
+    # Ringkasan item: satu GROUP BY untuk semua room di halaman
+    rooms = rooms_open + rooms_closed
     summaries = {}
-    for r in rooms_open + rooms_closed:
-        total_item = db.session.query(db.func.coalesce(db.func.sum(RoomItem.jumlah), 0)) \
-            .filter(RoomItem.room_id == r.id).scalar() or 0
-        summaries[r.id] = total_item
-    return render_template('rooms_list.html', rooms_open=rooms_open, rooms_closed=rooms_closed, summaries=summaries)
-
-def csv_response(filename: str, header: list, rows: list):
-    """Bikin response CSV untuk diunduh."""
-    si = io.StringIO()
-    cw = csv.writer(si)
-    if header:
-        cw.writerow(header)
-    for r in rows:
-        cw.writerow(r)
-    output = make_response(si.getvalue())
+    if rooms:
+        summaries = dict(db.session.query(RoomItem.room_id, func.coalesce(func.sum(RoomItem.jumlah), 0))
+                         .filter(RoomItem.room_id.in_([r.id for r in rooms]))
+                         .group_by(RoomItem.room_id)
+                         .all())
+    return render_template('rooms_list.html',
+                           rooms=rooms,
+                           rooms_open=rooms_open,
+                           rooms_closed=rooms_closed,
+                           summaries=summaries,
+                           closed_next_url=closed_next_url,
+                           closed_first_url=url_for('rooms_list') if before else None,
+                           retention_days=ROOM_RETENTION_DAYS)
+
+CSV_STREAM_BATCH = 500   # baris per potongan yang dikirim ke klien
+
+class _CsvEcho:
+    """Pseudo-file untuk csv.writer: writerow() langsung mengembalikan string barisnya."""
+    def write(self, value):
+        return value
+
+def _gzip_stream(chunks):
+    """Kompres potongan bytes secara streaming (format gzip), flush tiap potongan."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    yield z.flush()
+
+def csv_response(filename: str, header: list, rows, gzip_out: bool = False):
+    """
+    Bikin response CSV streaming untuk diunduh.
+    rows boleh berupa generator (mis. query .yield_per) → memori tetap datar berapa pun jumlah baris.
+    Header dikirim segera; baris berikutnya per CSV_STREAM_BATCH. gzip_out=True → file .csv.gz.
+    """
+    def generate():
+        cw = csv.writer(_CsvEcho())
+        if header:
+            yield cw.writerow(header).encode('utf-8')
+        buf = []
+        for r in rows:
+            buf.append(cw.writerow(r))
+            if len(buf) >= CSV_STREAM_BATCH:
+                yield ''.join(buf).encode('utf-8')
+                buf = []
+        if buf:
+            yield ''.join(buf).encode('utf-8')
+
+    body = generate()
+    content_type = "text/csv; charset=utf-8"
+    if gzip_out:
+        body = _gzip_stream(body)
+        filename = filename + ".gz"
+        content_type = "application/gzip"
+
+    output = Response(stream_with_context(body), content_type=content_type)
     output.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    output.headers["Content-Type"] = "text/csv; charset=utf-8"
     return output
 
 @app.route('/settings/data', methods=['GET', 'POST'], endpoint='settings_data')
@@ -2001,29 +3987,35 @@ def settings_data():
     """
     if request.method == 'POST':
         action = (request.form.get('action') or '').strip()
+        gz = request.form.get('gzip') == '1'
 
         # ========== EXPORTS ==========
+        # Baris dibaca per batch (yield_per) sebagai tuple kolom, lalu di-stream ke klien
         if action == 'export_produk':
-            rows = []
-            for p in Produk.query.order_by(Produk.id.asc()).all():
-                rows.append([
-                    p.id, p.nama, p.harga or 0, p.hpp or 0, p.stok or 0,
-                    (p.kategori.nama if p.kategori else ''), p.is_manufaktur or 0, (p.foto or '')
-                ])
-            header = ["id", "nama", "harga", "hpp", "stok", "kategori", "is_manufaktur", "foto"]
-            return csv_response("produk.csv", header, rows)
+            q = (db.session.query(
+                    Produk.id, Produk.nama, Produk.harga, Produk.hpp, Produk.stok,
+                    Kategori.nama, Produk.is_manufaktur, Produk.foto, Produk.barcode)
+                 .outerjoin(Kategori, Kategori.id == Produk.kategori_id)
+                 .order_by(Produk.id.asc())
+                 .yield_per(CSV_STREAM_BATCH))
+            rows = ([pid, nama, harga or 0, hpp or 0, stok or 0, kat or '', manu or 0, foto or '', bc or '']
+                    for pid, nama, harga, hpp, stok, kat, manu, foto, bc in q)
+            header = ["id", "nama", "harga", "hpp", "stok", "kategori", "is_manufaktur", "foto", "barcode"]
+            return csv_response("produk.csv", header, rows, gzip_out=gz)
 
         if action == 'export_kategori':
-            rows = []
-            for k in Kategori.query.order_by(Kategori.id.asc()).all():
-                rows.append([k.id, k.nama])
-            return csv_response("kategori.csv", ["id", "nama"], rows)
+            q = (db.session.query(Kategori.id, Kategori.nama)
+                 .order_by(Kategori.id.asc())
+                 .yield_per(CSV_STREAM_BATCH))
+            return csv_response("kategori.csv", ["id", "nama"], q, gzip_out=gz)
 
         if action == 'export_customer':
-            rows = []
-            for c in Customer.query.order_by(Customer.id.asc()).all():
-                rows.append([c.id, c.nama, c.email, c.no_telepon or '', c.alamat or ''])
-            return csv_response("customer.csv", ["id", "nama", "email", "no_telepon", "alamat"], rows)
+            q = (db.session.query(Customer.id, Customer.nama, Customer.email,
+                                  Customer.no_telepon, Customer.alamat)
+                 .order_by(Customer.id.asc())
+                 .yield_per(CSV_STREAM_BATCH))
+            rows = ([cid, nama, email, no or '', alamat or ''] for cid, nama, email, no, alamat in q)
+            return csv_response("customer.csv", ["id", "nama", "email", "no_telepon", "alamat"], rows, gzip_out=gz)
 
         # ========== IMPORTS ==========
         if action in ('import_produk', 'import_kategori', 'import_customer'):
@@ -2041,8 +4033,9 @@ def settings_data():
 
             try:
                 if action == 'import_produk':
-                    # Kolom yang diterima: id (opsional), nama, harga, hpp, stok, kategori, is_manufaktur, foto
+                    # Kolom yang diterima: id (opsional), nama, harga, hpp, stok, kategori, is_manufaktur, foto, barcode
                     # Jika 'kategori' berisi nama yang belum ada → dibuat otomatis
+                    # Tanpa id tapi barcode cocok → produk tsb yang di-update
                     for row in reader:
                         nama = (row.get('nama') or '').strip()
                         if not nama:
@@ -2053,6 +4046,7 @@ def settings_data():
                         kat_nama = (row.get('kategori') or '').strip()
                         is_manu  = int(row.get('is_manufaktur') or 0)
                         foto     = (row.get('foto') or '').strip()
+                        barcode  = (row.get('barcode') or '').strip() or None
 
                         kat_obj = None
                         if kat_nama:
@@ -2065,6 +4059,8 @@ def settings_data():
                         pid = row.get('id')
                         if pid and str(pid).isdigit():
                             p = Produk.query.get(int(pid))
+                        elif barcode:
+                            p = Produk.query.filter_by(barcode=barcode).first()
                         else:
                             p = None
 
@@ -2078,6 +4074,8 @@ def settings_data():
                             p.is_manufaktur = 1 if is_manu else 0
                             if foto:
                                 p.foto = foto
+                            if barcode:
+                                p.barcode = barcode
                         else:
                             # create
                             p = Produk(
@@ -2085,10 +4083,13 @@ def settings_data():
                                 harga=harga, hpp=hpp, stok=stok,
                                 kategori_id=kat_obj.id if kat_obj else None,
                                 is_manufaktur=1 if is_manu else 0,
-                                foto=foto or None
+                                foto=foto or None,
+                                barcode=barcode
                             )
                             db.session.add(p)
 
+                    bump_report_generation()
+                    bump_catalog_generation()
                     db.session.commit()
                     flash("Impor Produk selesai.", "success")
 
@@ -2109,6 +4110,7 @@ def settings_data():
                         else:
                             k = Kategori(nama=nama)
                             db.session.add(k)
+                    bump_catalog_generation()
                     db.session.commit()
                     flash("Impor Kategori selesai.", "success")
 
@@ -2167,67 +4169,61 @@ def settings_report():
         start_str = (request.form.get('start') or default_start).strip()
         end_str   = (request.form.get('end') or default_end).strip()
         tipe      = (request.form.get('tipe') or 'summary').strip()  # 'summary' / 'detail'
+        gz        = request.form.get('gzip') == '1'
 
-        # ambil transaksi periode
-        trs = (Transaksi.query
-               .filter(Transaksi.tanggal >= start_str,
-                       Transaksi.tanggal <= end_str)
-               .order_by(Transaksi.id.asc())
-               .all())
-
-        # kalkulasi sisa & laba approx per transaksi
+        # Baris dibaca per batch (yield_per) sebagai tuple kolom dan di-stream;
+        # HPP & harga memakai snapshot di ItemTransaksi.
         if tipe == 'summary':
             header = ["id", "tanggal", "customer", "total", "bayar", "sisa", "hpp_cost", "laba"]
-            rows = []
-            for t in trs:
-                _bayar = t.bayar or 0
-                _total = t.total or 0
-                _sisa  = t.sisa if t.sisa is not None else max(0, _total - _bayar)
-
-                # hpp_cost approx = Σ(item.qty × produk.hpp saat ini)
-                hpp_cost = 0
-                for it in t.item_transaksi:
-                    p = it.produk
-                    if p:
-                        hpp_cost += (p.hpp or 0) * (it.jumlah or 0)
-                laba = max(0, _total - hpp_cost)
-
-                rows.append([
-                    t.id,
-                    t.tanggal,
-                    (t.customer.nama if t.customer else ''),
-                    _total, _bayar, _sisa,
-                    hpp_cost, laba
-                ])
+            cost_sq = _trx_cost_subquery()
+            q = (db.session.query(
+                    Transaksi.id, Transaksi.tanggal, Customer.nama,
+                    Transaksi.total, Transaksi.bayar, Transaksi.sisa,
+                    func.coalesce(cost_sq.c.hpp_cost, 0))
+                 .outerjoin(cost_sq, cost_sq.c.transaksi_id == Transaksi.id)
+                 .outerjoin(Customer, Customer.id == Transaksi.customer_id)
+                 .filter(Transaksi.tanggal >= start_str,
+                         Transaksi.tanggal <= end_str)
+                 .order_by(Transaksi.id.asc())
+                 .yield_per(CSV_STREAM_BATCH))
+
+            def rows():
+                for trx_id, tanggal, cust, total, bayar, sisa, hpp_cost in q:
+                    _bayar = bayar or 0
+                    _total = total or 0
+                    _sisa  = sisa if sisa is not None else max(0, _total - _bayar)
+                    hpp_cost = int(hpp_cost or 0)
+                    laba = max(0, _total - hpp_cost)
+                    yield [trx_id, tanggal, cust or '', _total, _bayar, _sisa, hpp_cost, laba]
+
             filename = f"laporan_summary_{start_str}_to_{end_str}.csv"
-            return csv_response(filename, header, rows)
+            return csv_response(filename, header, rows(), gzip_out=gz)
 
         else:
             # detail: per item transaksi (dengan produk)
-            header = ["trx_id", "tanggal", "customer", "produk", "qty", "harga_jual_satuan", "subtotal", "hpp_satuan(approx)", "hpp_total(approx)"]
-            rows = []
-            for t in trs:
-                cust = (t.customer.nama if t.customer else '')
-                for it in t.item_transaksi:
-                    p = it.produk
-                    if not p:
-                        continue
-                    qty = it.jumlah or 0
-                    # kita tidak menyimpan harga_satuan snapshot di ItemTransaksi.
-                    # maka perhitungan subtotal approx = qty × harga produk saat ini (bisa beda dari saat transaksi)
-                    # Kalau Anda punya field harga snapshot, gunakan itu di sini.
-                    harga_jual_satuan = p.harga or 0
-                    subtotal = harga_jual_satuan * qty
-
-                    hpp_satuan = p.hpp or 0
-                    hpp_total  = hpp_satuan * qty
-
-                    rows.append([
-                        t.id, t.tanggal, cust,
-                        p.nama, qty, harga_jual_satuan, subtotal, hpp_satuan, hpp_total
-                    ])
+            header = ["trx_id", "tanggal", "customer", "produk", "qty", "harga_jual_satuan", "subtotal", "hpp_satuan", "hpp_total"]
+            q = (db.session.query(
+                    Transaksi.id, Transaksi.tanggal, Customer.nama, Produk.nama,
+                    ItemTransaksi.jumlah, ItemTransaksi.harga_satuan, ItemTransaksi.hpp_satuan)
+                 .join(ItemTransaksi, ItemTransaksi.transaksi_id == Transaksi.id)
+                 .join(Produk, Produk.id == ItemTransaksi.produk_id)
+                 .outerjoin(Customer, Customer.id == Transaksi.customer_id)
+                 .filter(Transaksi.tanggal >= start_str,
+                         Transaksi.tanggal <= end_str)
+                 .order_by(Transaksi.id.asc(), ItemTransaksi.id.asc())
+                 .yield_per(CSV_STREAM_BATCH))
+
+            def rows():
+                for trx_id, tanggal, cust, nama, qty, harga, hpp in q:
+                    qty = qty or 0
+                    harga_jual_satuan = harga or 0
+                    hpp_satuan = hpp or 0
+                    yield [trx_id, tanggal, cust or '', nama, qty,
+                           harga_jual_satuan, harga_jual_satuan * qty,
+                           hpp_satuan, hpp_satuan * qty]
+
             filename = f"laporan_detail_{start_str}_to_{end_str}.csv"
-            return csv_response(filename, header, rows)
+            return csv_response(filename, header, rows(), gzip_out=gz)
 
     # GET
     return render_template('settings_report.html',
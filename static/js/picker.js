@@ -0,0 +1,63 @@
+// picker.js
+// Picker pencarian server-side (customer, produk, ...) untuk filter laporan.
+// Markup:
+//   <div class="picker" data-src="/api/x/cari" data-key="x" data-sub="field_opsional">
+//     <input type="text" class="picker-input"> <input type="hidden" class="picker-value">
+//     <div class="picker-list" role="listbox"></div>
+//   </div>
+// data-key = nama array hasil di respons JSON; item wajib punya id & nama.
+
+(function(){
+  const esc = s => String(s ?? '').replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
+
+  function pasang(box){
+    const input  = box.querySelector('.picker-input');
+    const hidden = box.querySelector('.picker-value');
+    const list   = box.querySelector('.picker-list');
+    const { src, key, sub } = box.dataset;
+    let timer = null, seq = 0;
+
+    function tutup(){ list.style.display = 'none'; list.innerHTML = ''; }
+
+    async function cari(q){
+      const my = ++seq;
+      try{
+        const res = await fetch(`${src}?limit=15&q=${encodeURIComponent(q)}`);
+        if(!res.ok || my !== seq) return;
+        const data = await res.json();
+        if(my !== seq) return;
+        const hasil = data[key] || [];
+        if(!hasil.length){ tutup(); return; }
+        list.innerHTML = hasil.map(r =>
+          `<div role="option" data-id="${r.id}" data-nama="${esc(r.nama)}">${esc(r.nama)}` +
+          `${sub && r[sub] ? ` <span class="picker-sub">${esc(r[sub])}</span>` : ''}</div>`
+        ).join('');
+        list.style.display = 'block';
+      }catch(err){ tutup(); }
+    }
+
+    input.addEventListener('input', () => {
+      hidden.value = '';  // teks diubah → pilihan lama batal (kosong = semua)
+      clearTimeout(timer);
+      const q = input.value.trim();
+      if(!q){ seq++; tutup(); return; }
+      timer = setTimeout(() => cari(q), 200);
+    });
+
+    list.addEventListener('mousedown', (e) => {
+      const opt = e.target.closest('[data-id]');
+      if(!opt) return;
+      e.preventDefault();
+      hidden.value = opt.dataset.id;
+      input.value  = opt.dataset.nama;
+      tutup();
+    });
+
+    input.addEventListener('blur', () => setTimeout(tutup, 150));
+    input.addEventListener('keydown', (e) => { if(e.key === 'Escape') tutup(); });
+  }
+
+  document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('.picker[data-src]').forEach(pasang);
+  });
+})();